@@ -0,0 +1,366 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid as uuidlib
+from functools import partial
+
+from nbt import nbt
+from prometheus_client import CollectorRegistry, REGISTRY, generate_latest
+
+from minecraft_exporter import build_player_samples, load_stat_mappings
+
+PHASES = ("quests", "players", "names", "fingerprints", "parse", "build", "families", "server")
+
+# canned responses of the fake RCON server
+RCON_RESPONSES = {
+    "list": "There are 3 of a max of 20 players online: Alice, Bob, Carol",
+    "tps": "§aTPS from last 1m, 5m, 15m: §a19.98, §a19.99, §a20.0",
+    "forge tps": "Dim  0 (overworld): Mean tick time: 12.345 ms. Mean TPS: 20.000\n"
+                 "Dim -1 (the_nether): Mean tick time: 1.234 ms. Mean TPS: 20.000\n"
+                 "Dim  1 (the_end): Mean tick time: 0.123 ms. Mean TPS: 20.000\n"
+                 "Overall: Mean tick time: 13.702 ms. Mean TPS: 20.000",
+    "forge entity list": "Total: 1234\n" + "".join("  %d: minecraft:entity_%d\n" % (100 - i, i) for i in range(40)),
+    "dynmap stats": "Tile Render Statistics:\n"
+                    "  world.flat: processed=1200, rendered=1100, updated=100\n"
+                    "  world_nether.flat: processed=300, rendered=250, updated=50\n"
+                    "Chunk Loading Statistics:\n"
+                    "  Chunks processed: Cached: count=5000, 0.01 msec/chunk\n"
+                    "  Chunks processed: Already Loaded: count=1000, 0.52 msec/chunk",
+}
+
+
+def synthetic_stats(rng, modern, blocks):
+    if not modern:  # pre 1.15
+        data = {"stat.mineBlock.minecraft.block_%d" % i: rng.randint(1, 10000) for i in range(blocks)}
+        data.update({"stat.jump": 10, "stat.walkOneCm": 1000, "stat.entityKilledBy.Zombie": 2,
+                     "stat.killEntity.Cow": 5, "stat.damageTaken": 40, "stat.playOneMinute": 1200})
+    else:
+        data = {"DataVersion": 2586, "stats": {
+            "minecraft:mined": {"minecraft:block_%d" % i: rng.randint(1, 10000) for i in range(blocks)},
+            "minecraft:picked_up": {"minecraft:item_%d" % i: rng.randint(1, 100) for i in range(blocks // 2)},
+            "minecraft:killed": {"minecraft:zombie": 12, "minecraft:cow": 3},
+            "minecraft:custom": {"minecraft:jump": 10, "minecraft:walk_one_cm": 1000, "minecraft:play_time": 1200,
+                                 "minecraft:deaths": 2, "minecraft:bell_ring": 1},
+        }}
+    return data
+
+
+def write_playerdata(path, rng, inventory):
+    playerdata = nbt.NBTFile()
+    playerdata.name = ""
+    playerdata.tags.extend([
+        nbt.TAG_Int(name="XpTotal", value=rng.randint(0, 10000)), nbt.TAG_Int(name="XpLevel", value=rng.randint(0, 50)),
+        nbt.TAG_Int(name="Score", value=rng.randint(0, 10000)), nbt.TAG_Float(name="Health", value=20.0),
+        nbt.TAG_Int(name="foodLevel", value=rng.randint(0, 20)),
+        nbt.TAG_String(name="Dimension", value="minecraft:overworld"),
+    ])
+    pos = nbt.TAG_List(name="Pos", type=nbt.TAG_Double)
+    pos.tags.extend(nbt.TAG_Double(value=rng.uniform(-1000, 1000)) for _ in range(3))
+    playerdata.tags.append(pos)
+    # inventories of modded players are what makes playerdata files big
+    for list_name in ("Inventory", "EnderItems"):
+        items = nbt.TAG_List(name=list_name, type=nbt.TAG_Compound)
+        for slot in range(inventory):
+            item = nbt.TAG_Compound()
+            item.tags.extend([nbt.TAG_Byte(name="Slot", value=slot % 128),
+                              nbt.TAG_String(name="id", value="minecraft:item_%d" % rng.randint(0, 500)),
+                              nbt.TAG_Byte(name="Count", value=rng.randint(1, 64))])
+            tag = nbt.TAG_Compound(name="tag")
+            tag.tags.append(nbt.TAG_Int_Array(name="energy"))
+            tag.tags[0].value = [rng.randint(0, 1 << 20) for _ in range(16)]
+            item.tags.append(tag)
+            items.tags.append(item)
+        playerdata.tags.append(items)
+    playerdata.write_file(path)
+
+
+def generate_world(directory, players, blocks=200, inventory=36, stats_format="mixed", quests=0, seed=0):
+    # writes <directory>/world and <directory>/usercache.json, returns the player uuids
+    rng = random.Random(seed)
+    world = os.path.join(directory, "world")
+    for sub in ("stats", "playerdata", "advancements"):
+        os.makedirs(os.path.join(world, sub), exist_ok=True)
+    uuids = [str(uuidlib.UUID(int=rng.getrandbits(128), version=4)) for _ in range(players)]
+    for i, uuid in enumerate(uuids):
+        modern = stats_format == "modern" or stats_format == "mixed" and i % 2 == 0
+        with open(os.path.join(world, "stats", uuid + ".json"), "w") as json_file:
+            json.dump(synthetic_stats(rng, modern, blocks), json_file)
+        with open(os.path.join(world, "advancements", uuid + ".json"), "w") as json_file:
+            advancements = {"minecraft:story/advancement_%d" % a: {"criteria": {}, "done": rng.random() < 0.5}
+                            for a in range(60)}
+            advancements["DataVersion"] = 2586
+            json.dump(advancements, json_file)
+        write_playerdata(os.path.join(world, "playerdata", uuid + ".dat"), rng, inventory)
+    if quests:
+        os.makedirs(os.path.join(world, "betterquesting"), exist_ok=True)
+        progress = {"questProgress:9": {
+            "%d:10" % q: {"questID:3": q, "tasks:9": {"0:10": {"completeUsers:9": {
+                "%d:8" % n: uuid for n, uuid in enumerate(u for u in uuids if rng.random() < 0.3)}}}}
+            for q in range(quests)}}
+        with open(os.path.join(world, "betterquesting", "QuestProgress.json"), "w") as json_file:
+            json.dump(progress, json_file)
+    with open(os.path.join(directory, "usercache.json"), "w") as json_file:
+        json.dump([{"name": "player_%d" % i, "uuid": uuid, "expiresOn": "2100-01-01 00:00:00 +0000"}
+                   for i, uuid in enumerate(uuids)], json_file)
+    return uuids
+
+
+class FakeRconHandler(socketserver.BaseRequestHandler):
+    def read_packet(self):
+        header = self.request.recv(4)
+        if len(header) < 4:
+            return None
+        length, = struct.unpack("<i", header)
+        payload = b""
+        while len(payload) < length:
+            chunk = self.request.recv(length - len(payload))
+            if not chunk:
+                return None
+            payload += chunk
+        request_id, typ = struct.unpack("<ii", payload[:8])
+        return request_id, typ, payload[8:-2].decode()
+
+    def send_packet(self, request_id, typ, body):
+        payload = struct.pack("<ii", request_id, typ) + body.encode() + b"\0\0"
+        self.request.sendall(struct.pack("<i", len(payload)) + payload)
+
+    def setup(self):
+        self.server.connections.add(self.request)
+
+    def finish(self):
+        self.server.connections.discard(self.request)
+
+    def handle(self):
+        while True:
+            packet = self.read_packet()
+            if packet is None:
+                return
+            request_id, typ, body = packet
+            if typ == 3:  # login
+                self.send_packet(request_id, 2, "")
+                continue
+            time.sleep(self.server.latency.get(body, 0))
+            self.send_packet(request_id, 0, RCON_RESPONSES.get(body, "Unknown command"))
+
+
+class FakeRconServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=None, port=0):
+        super().__init__(("127.0.0.1", port), FakeRconHandler)
+        # command -> seconds the response is delayed
+        self.latency = latency or {}
+        self.connections = set()
+        threading.Thread(target=self.serve_forever, name="fake-rcon", daemon=True).start()
+
+    def stop(self):
+        # like a server going down, open connections are dropped as well
+        self.shutdown()
+        self.server_close()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def phase_seconds():
+    return {phase: REGISTRY.get_sample_value('minecraft_exporter_phase_duration_seconds_sum',
+                                             {'server': "", 'phase': phase}) or 0
+            for phase in PHASES}
+
+
+def timed_scrape(scrape):
+    phases = phase_seconds()
+    started = time.perf_counter()
+    body = scrape()
+    elapsed = time.perf_counter() - started
+    phases = {phase: seconds - phases[phase] for phase, seconds in phase_seconds().items()}
+    # whatever is not spent collecting is spent rendering the exposition format
+    phases["render"] = elapsed - sum(phases.values())
+    return elapsed, len(body), phases
+
+
+def touch_players(world, uuids, rng, churn):
+    for uuid in rng.sample(uuids, int(len(uuids) * churn)):
+        os.utime(os.path.join(world, "stats", uuid + ".json"))
+
+
+def bench_scrape(args):
+    # one scale point, run in its own process so peak RSS is not shared between scale points
+    from minecraft_exporter import MinecraftCollector
+
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        uuids = generate_world(directory, args.players, args.blocks, args.inventory, args.format, args.quests)
+        generate_seconds = time.perf_counter() - started
+        world = os.path.join(directory, "world")
+        os.environ.update({'WORLD_DIR': world, 'USERCACHE_FILE': os.path.join(directory, "usercache.json"),
+                           'NAME_CACHE_FILE': "", 'PARSE_WORKERS': str(args.workers), 'PARSE_POOL': args.pool})
+        rcon = None
+        if args.rcon:
+            rcon = FakeRconServer({"forge entity list": args.rcon_latency})
+            os.environ.update({'RCON_HOST': "127.0.0.1", 'RCON_PORT': str(rcon.port), 'RCON_PASSWORD': "bench",
+                               'FORGE_SERVER': "True", 'PAPER_SERVER': "True", 'DYNMAP_ENABLED': "True"})
+        os.environ['PRERENDER'] = str(args.prerender)
+        collector = MinecraftCollector()
+        if args.prerender:
+            def scrape():
+                exposition = collector.exposition()
+                exposition.chunks(True)  # scrapers accept gzip
+                return b"".join(exposition.chunks(False))
+        else:
+            registry = CollectorRegistry(auto_describe=False)
+            registry.register(collector)
+            scrape = partial(generate_latest, registry)
+
+        cold, body_bytes, cold_phases = timed_scrape(scrape)
+        rng = random.Random(1)
+        warm = []
+        warm_phases = {phase: 0.0 for phase in PHASES + ("render",)}
+        for _ in range(args.scrapes):
+            touch_players(world, uuids, rng, args.churn)
+            elapsed, body_bytes, phases = timed_scrape(scrape)
+            warm.append(elapsed)
+            for phase, seconds in phases.items():
+                warm_phases[phase] += seconds / args.scrapes
+
+        tracemalloc.start()
+        touch_players(world, uuids, rng, args.churn)
+        scrape()
+        warm_alloc_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if rcon is not None:
+            rcon.shutdown()
+
+    return {
+        "players": args.players, "blocks": args.blocks, "format": args.format, "workers": args.workers,
+        "pool": args.pool, "churn": args.churn, "rcon": args.rcon, "prerender": args.prerender, "generate_seconds": generate_seconds,
+        "body_bytes": body_bytes,
+        "cold_seconds": cold,
+        "cold_phase_seconds": cold_phases,
+        "warm_seconds": {"p50": percentile(warm, 50), "p90": percentile(warm, 90), "p99": percentile(warm, 99),
+                         "max": max(warm)} if warm else None,
+        "warm_phase_seconds": warm_phases,
+        "warm_alloc_peak_bytes": warm_alloc_peak,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def bench_build(args):
+    rng = random.Random(0)
+    _, mappings = load_stat_mappings(args.mapping_file)
+    results = dict()
+    for modern in (False, True):
+        stats = [synthetic_stats(rng, modern, args.blocks) for _ in range(args.players)]
+        for data in stats:
+            data.update({"stat.XpTotal": 100, "stat.XpLevel": 5, "stat.Score": 100, "stat.Health": 20.0,
+                         "stat.foodLevel": 20, "stat.advancements": 12})
+        started = time.perf_counter()
+        samples = sum(len(s) for data in stats for s in build_player_samples(mappings, "player", data).values())
+        elapsed = time.perf_counter() - started
+        results["modern" if modern else "legacy"] = {"players": args.players, "samples": samples,
+                                                     "us_per_player": elapsed / args.players * 1e6}
+    return results
+
+
+def run_scale_points(args):
+    results = []
+    for players in args.scale:
+        command = [sys.executable, os.path.abspath(__file__), "scrape", "--single", "--players", str(players),
+                   "--blocks", str(args.blocks), "--inventory", str(args.inventory), "--format", args.format,
+                   "--quests", str(args.quests), "--scrapes", str(args.scrapes), "--churn", str(args.churn),
+                   "--workers", str(args.workers), "--pool", args.pool, "--rcon-latency", str(args.rcon_latency)]
+        if args.rcon:
+            command.append("--rcon")
+        if args.prerender:
+            command.append("--prerender")
+        print(f"benchmarking {players} players", file=sys.stderr)
+        results.append(json.loads(subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the minecraft exporter")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="per player cost of building metric samples")
+    build.add_argument("--players", type=int, default=1000)
+    build.add_argument("--blocks", type=int, default=200, help="mined blocks per player")
+    build.add_argument("--mapping-file", help="STAT_MAPPING_FILE to benchmark with")
+
+    scrape = commands.add_parser("scrape", help="scrape latency of synthetic worlds")
+    scrape.add_argument("--scale", type=lambda s: [int(n) for n in s.split(",")], default=[100, 1000],
+                        help="comma separated player counts")
+    scrape.add_argument("--players", type=int, help=argparse.SUPPRESS)
+    scrape.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    scrape.add_argument("--blocks", type=int, default=200, help="mined blocks per player")
+    scrape.add_argument("--inventory", type=int, default=36, help="inventory and ender chest items per player")
+    scrape.add_argument("--format", choices=("legacy", "modern", "mixed"), default="mixed", help="stats format")
+    scrape.add_argument("--quests", type=int, default=0, help="BetterQuesting quests to generate")
+    scrape.add_argument("--scrapes", type=int, default=20, help="warm scrapes per scale point")
+    scrape.add_argument("--churn", type=float, default=0.01, help="share of players changed between scrapes")
+    scrape.add_argument("--workers", type=int, default=1, help="PARSE_WORKERS")
+    scrape.add_argument("--pool", choices=("thread", "process"), default="thread", help="PARSE_POOL")
+    scrape.add_argument("--rcon", action="store_true", help="scrape a fake RCON server as well")
+    scrape.add_argument("--rcon-latency", type=float, default=0.0, help="delay of 'forge entity list'")
+    scrape.add_argument("--prerender", action="store_true", help="serve pre-rendered output like PRERENDER")
+
+    generate = commands.add_parser("generate", help="write a synthetic world")
+    generate.add_argument("directory")
+    generate.add_argument("--players", type=int, default=100)
+    generate.add_argument("--blocks", type=int, default=200)
+    generate.add_argument("--inventory", type=int, default=36)
+    generate.add_argument("--format", choices=("legacy", "modern", "mixed"), default="mixed")
+    generate.add_argument("--quests", type=int, default=0)
+
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        generate_world(args.directory, args.players, args.blocks, args.inventory, args.format, args.quests)
+        return
+    if args.command == "build":
+        results = bench_build(args)
+    elif args.single:
+        # the exporter logs to stdout, keep it free for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results = bench_scrape(args)
+    else:
+        results = run_scale_points(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,91 +1,1481 @@
+import cProfile
+import gzip
+import hashlib
+import heapq
 import json
 import os
+import pstats
+import queue
 import re
+import signal
+import random
+import struct
+import sys
+import threading
 import time
+import tracemalloc
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from os import listdir
 from os.path import isfile, join
 
-import nbt
 import requests
 import schedule
 from mcipc.rcon.je import Client
-from prometheus_client import Metric, REGISTRY, start_http_server
+from prometheus_client import (CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, Metric, REGISTRY, generate_latest,
+                               start_http_server)
+from prometheus_client.samples import Sample
+from prometheus_client.utils import floatToGoString
 
+MOJANG_SESSION_URL = "https://sessionserver.mojang.com/session/minecraft/profile/"
+PROFILE_LOCK = threading.Lock()
 
-class MinecraftCollector(object):
-    def __init__(self):
-        self.stats_directory = "/world/stats"
-        self.player_directory = "/world/playerdata"
-        self.advancements_directory = "/world/advancements"
-        self.better_questing = "/world/betterquesting"
-        self.player_map = dict()
-        self.quests_enabled = False
+PHASE_DURATION = Histogram('minecraft_exporter_phase_duration_seconds', 'Time spent in each phase of a collection',
+                           ['server', 'phase'])
+FILE_PARSE_DURATION = Histogram('minecraft_exporter_file_parse_duration_seconds',
+                                'Time spent reading and decoding a world file', ['file'])
+FILE_READ_BYTES = Counter('minecraft_exporter_file_read_bytes', 'Bytes read from world files', ['file'])
+NAME_LOOKUP_DURATION = Histogram('minecraft_exporter_name_lookup_duration_seconds',
+                                 'Time a player name lookup at Mojang took')
+RCON_COMMAND_DURATION = Histogram('minecraft_exporter_rcon_command_duration_seconds', 'Time an RCON command took',
+                                  ['command'])
+CACHE_REQUESTS = Counter('minecraft_exporter_cache_requests', 'Cache lookups by cache and result', ['cache', 'result'])
+ERRORS = Counter('minecraft_exporter_errors', 'Errors by source', ['source'])
+SERIES = Gauge('minecraft_exporter_series', 'Number of series produced by the last collection', ['server'])
+SERIES_DROPPED = Gauge('minecraft_exporter_series_dropped',
+                       'Series dropped by namespace filters or folded into "other" by top-K limits', ['server', 'metric'])
+WORLD_SCAN_DURATION = Histogram('minecraft_exporter_world_scan_duration_seconds', 'Time a scan of the region files took',
+                                ['server'])
+PLAYER_TIERS = Gauge('minecraft_exporter_players', 'Players of the last collection by refresh tier', ['server', 'tier'])
 
-        self.rcon = None
-        self.rcon_connected = False
-        if all(x in os.environ for x in ['RCON_HOST', 'RCON_PASSWORD']):
-            self.rcon = Client(os.environ['RCON_HOST'], int(os.environ['RCON_PORT']),passwd=os.environ['RCON_PASSWORD'])
-            print("RCON is enabled for " + os.environ['RCON_HOST'])
 
-        if os.path.isdir(self.better_questing):
-            self.quests_enabled = True
+# NBT tag ids, see https://minecraft.wiki/w/NBT_format
+TAG_END, TAG_BYTE, TAG_SHORT, TAG_INT, TAG_LONG, TAG_FLOAT, TAG_DOUBLE, TAG_BYTE_ARRAY, TAG_STRING, TAG_LIST, \
+    TAG_COMPOUND, TAG_INT_ARRAY, TAG_LONG_ARRAY = range(13)
+NBT_SCALARS = {TAG_BYTE: struct.Struct(">b"), TAG_SHORT: struct.Struct(">h"), TAG_INT: struct.Struct(">i"),
+               TAG_LONG: struct.Struct(">q"), TAG_FLOAT: struct.Struct(">f"), TAG_DOUBLE: struct.Struct(">d")}
+NBT_ARRAYS = {TAG_BYTE_ARRAY: "b", TAG_INT_ARRAY: "i", TAG_LONG_ARRAY: "q"}
+NBT_LENGTH = struct.Struct(">i")
+NBT_STRING_LENGTH = struct.Struct(">H")
 
-        schedule.every().day.at("01:00").do(self.flush_playernamecache)
+# tags every playerdata file is read for, more can be added with PLAYERDATA_TAGS
+PLAYERDATA_TAGS = ("XpTotal", "XpLevel", "Score", "Health", "foodLevel")
 
-    def get_players(self):
-        return [f[:-5] for f in listdir(self.stats_directory) if isfile(join(self.stats_directory, f))]
 
-    def flush_playernamecache(self):
-        print("flushing playername cache")
-        self.player_map = dict()
+def nbt_paths(paths):
+    # "abilities.flying" -> {"abilities": {"flying": None}}, None selects the whole value
+    tree = dict()
+    for path in paths:
+        node = tree
+        *parents, leaf = path.split(".")
+        for parent in parents:
+            if node.get(parent, {}) is None:
+                break
+            node = node.setdefault(parent, dict())
+        else:
+            node[leaf] = None
+    return tree
 
-    def uuid_to_player(self, uuid):
-        if uuid in self.player_map:
-            return self.player_map[uuid]
+
+def nbt_read_string(buf, offset):
+    length, = NBT_STRING_LENGTH.unpack_from(buf, offset)
+    offset += 2
+    return buf[offset:offset + length].decode("utf-8", errors="replace"), offset + length
+
+
+def nbt_skip(buf, offset, tag):
+    if tag in NBT_SCALARS:
+        return offset + NBT_SCALARS[tag].size
+    if tag in NBT_ARRAYS:
+        length, = NBT_LENGTH.unpack_from(buf, offset)
+        return offset + 4 + length * struct.calcsize(NBT_ARRAYS[tag])
+    if tag == TAG_STRING:
+        length, = NBT_STRING_LENGTH.unpack_from(buf, offset)
+        return offset + 2 + length
+    if tag == TAG_LIST:
+        item_tag = buf[offset]
+        length, = NBT_LENGTH.unpack_from(buf, offset + 1)
+        offset += 5
+        if item_tag in NBT_SCALARS:
+            return offset + max(length, 0) * NBT_SCALARS[item_tag].size
+        for _ in range(length):
+            offset = nbt_skip(buf, offset, item_tag)
+        return offset
+    if tag == TAG_COMPOUND:
+        while True:
+            item_tag = buf[offset]
+            offset += 1
+            if item_tag == TAG_END:
+                return offset
+            length, = NBT_STRING_LENGTH.unpack_from(buf, offset)
+            offset = nbt_skip(buf, offset + 2 + length, item_tag)
+    raise ValueError(f"Unknown NBT tag {tag} at offset {offset}")
+
+
+def nbt_read(buf, offset, tag, wanted=None):
+    # returns (value, offset), wanted restricts compounds (or each compound of a list) to a subtree
+    if tag in NBT_SCALARS:
+        return NBT_SCALARS[tag].unpack_from(buf, offset)[0], offset + NBT_SCALARS[tag].size
+    if tag in NBT_ARRAYS:
+        length, = NBT_LENGTH.unpack_from(buf, offset)
+        fmt = NBT_ARRAYS[tag]
+        end = offset + 4 + length * struct.calcsize(fmt)
+        return list(struct.unpack_from(f">{length}{fmt}", buf, offset + 4)), end
+    if tag == TAG_STRING:
+        return nbt_read_string(buf, offset)
+    if tag == TAG_LIST:
+        item_tag = buf[offset]
+        length, = NBT_LENGTH.unpack_from(buf, offset + 1)
+        offset += 5
+        values = []
+        for _ in range(length):
+            value, offset = nbt_read(buf, offset, item_tag, wanted)
+            values.append(value)
+        return values, offset
+    if tag == TAG_COMPOUND:
+        values = dict()
+        while True:
+            item_tag = buf[offset]
+            offset += 1
+            if item_tag == TAG_END:
+                return values, offset
+            name, offset = nbt_read_string(buf, offset)
+            if wanted is None:
+                values[name], offset = nbt_read(buf, offset, item_tag)
+            elif name in wanted and (wanted[name] is None or item_tag in (TAG_COMPOUND, TAG_LIST)):
+                values[name], offset = nbt_read(buf, offset, item_tag, wanted[name])
+            else:
+                offset = nbt_skip(buf, offset, item_tag)
+    raise ValueError(f"Unknown NBT tag {tag} at offset {offset}")
+
+
+def read_nbt(buf, wanted):
+    # buf holds an uncompressed NBT document with a compound root
+    if buf[0] != TAG_COMPOUND:
+        raise ValueError("NBT root is not a compound")
+    _, offset = nbt_read_string(buf, 1)
+    return nbt_read(buf, offset, TAG_COMPOUND, wanted)[0]
+
+
+def read_nbt_file(path, wanted):
+    with open(path, "rb") as nbt_file:
+        return read_nbt_bytes(nbt_file.read(), wanted)
+
+
+def read_nbt_bytes(raw, wanted):
+    # wbits 47 accepts both gzip and zlib streams
+    return read_nbt(zlib.decompress(raw, 47), wanted)
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def flatten_nbt(values, prefix=""):
+    for name, value in values.items():
+        if isinstance(value, dict):
+            yield from flatten_nbt(value, prefix + name + ".")
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                if isinstance(item, (int, float, str)):
+                    yield f"{prefix}{name}.{i}", item
         else:
-            try:
-                result = requests.get('https://sessionserver.mojang.com/session/minecraft/profile/' + uuid)
-                self.player_map[uuid] = result.json()['name']
-                return (result.json()['name'])
-            except:
-                return
+            yield prefix + name, value
+
+
+def read_player_files(stats_file, player_file, advancements_file, playerdata_tags=None, inventory_items=None,
+                      timings=None):
+    # timings receives file -> (seconds, bytes read)
+    started = time.perf_counter()
+    raw = read_file(stats_file)
+    data = json.loads(raw)
+    if timings is not None:
+        timings["stats"] = (time.perf_counter() - started, len(raw))
+
+    started = time.perf_counter()
+    wanted = nbt_paths(PLAYERDATA_TAGS + tuple(playerdata_tags or ()))
+    if inventory_items:
+        wanted["Inventory"] = {"id": None, "Count": None, "count": None}
+    raw = read_file(player_file)
+    playerdata = read_nbt_bytes(raw, wanted)
+    for tag in PLAYERDATA_TAGS:
+        if tag in playerdata:
+            data["stat." + tag] = playerdata[tag]
+    if playerdata_tags:
+        tags = dict(flatten_nbt({k: playerdata[k] for k in nbt_paths(playerdata_tags) if k in playerdata}))
+        data["stat.nbt"] = {tag: value for tag, value in tags.items() if not isinstance(value, str)}
+        data["stat.nbtInfo"] = {tag: value for tag, value in tags.items() if isinstance(value, str)}
+    if inventory_items:
+        inventory = dict()
+        for item in playerdata.get("Inventory", []):
+            if item.get("id") in inventory_items:
+                inventory[item["id"]] = inventory.get(item["id"], 0) + item.get("Count", item.get("count", 1))
+        data["stat.inventory"] = inventory
+    if timings is not None:
+        timings["playerdata"] = (time.perf_counter() - started, len(raw))
+
+    started = time.perf_counter()
+    raw = read_file(advancements_file)
+    count = 0
+    advancements = json.loads(raw)
+    for key, value in advancements.items():
+        if key in ("DataVersion"):
+            continue
+        if value["done"] == True:
+            count += 1
+    data["stat.advancements"] = count
+    if timings is not None:
+        timings["advancements"] = (time.perf_counter() - started, len(raw))
+    return data
+
+
+def read_quest_index(progress_file, database_file):
+    with open(progress_file) as json_file:
+        progress = json.load(json_file)
+
+    # quest id -> chapter name, only available if the quest database is present
+    chapters = dict()
+    if os.path.isfile(database_file):
+        with open(database_file) as json_file:
+            database = json.load(json_file)
+        for line_key, line in database.get('questLines:9', {}).items():
+            chapter = line.get('properties:10', {}).get('betterquesting:10', {}).get('name:8')
+            if not chapter:
+                chapter = str(line.get('lineID:3', line_key.split(":")[0]))
+            for _, quest in line.get('quests:9', {}).items():
+                chapters[quest.get('id:3')] = chapter
+
+    finished = dict()
+    finished_by_chapter = dict()
+    completions = dict()
+    for key, value in progress['questProgress:9'].items():
+        quest = value.get('questID:3', key.split(":")[0])
+        chapter = chapters.get(quest)
+        users = value.get('tasks:9', {}).get('0:10', {}).get('completeUsers:9', {})
+        completions[str(quest)] = len(users)
+        for _, uuid in users.items():
+            finished[uuid] = finished.get(uuid, 0) + 1
+            if chapter is not None:
+                by_chapter = finished_by_chapter.setdefault(uuid, dict())
+                by_chapter[chapter] = by_chapter.get(chapter, 0) + 1
+    return finished, finished_by_chapter, completions
+
+
+# runs inside the parse pool, a single broken player must not fail the whole collection.
+# Returns (data, timings) as metrics observed inside a process pool would never be exported.
+def parse_player_files(stats_file, player_file, advancements_file, playerdata_tags=None, inventory_items=None):
+    timings = dict()
+    try:
+        return read_player_files(stats_file, player_file, advancements_file, playerdata_tags, inventory_items,
+                                 timings), timings
+    except Exception as e:
+        print("Failed to parse player files for", stats_file, e)
+        return None, timings
+
+
+def file_fingerprint(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+# metric name -> (documentation, type) of every per player metric
+PLAYER_METRICS = {
+    'blocks_mined': ('Blocks a Player mined', "counter"),
+    'blocks_picked_up': ('Blocks a Player picked up', "counter"),
+    'player_deaths': ('How often a Player died', "counter"),
+    'player_jumps': ('How often a Player has jumped', "counter"),
+    'cm_traveled': ('How many cm a Player traveled, whatever that means', "counter"),
+    'player_xp_total': ("How much total XP a player has", "counter"),
+    'player_current_level': ("How much current XP a player has", "counter"),
+    'player_food_level': ("How much food the player currently has", "counter"),
+    'player_health': ("How much Health the player currently has", "counter"),
+    'player_score': ("The Score of the player", "counter"),
+    'entities_killed': ("Entities killed by player", "counter"),
+    'damage_taken': ("Damage Taken by Player", "counter"),
+    'damage_dealt': ("Damage dealt by Player", "counter"),
+    'blocks_crafted': ("Items a Player crafted", "counter"),
+    'player_playtime': ("Time in Minutes a Player was online", "counter"),
+    'player_advancements': ("Number of completed advances of a player", "counter"),
+    'player_slept': ("Times a Player slept in a bed", "counter"),
+    'player_used_crafting_table': ("Times a Player used a Crafting Table", "counter"),
+    'player_quests_finished': ('Number of quests a Player has finished', 'counter'),
+    'player_quests_finished_by_chapter': ('Number of quests a Player has finished per chapter', 'counter'),
+    'mc_custom': ("Custom Minecraft stat", "counter"),
+    'player_nbt': ("Numeric playerdata tag selected with PLAYERDATA_TAGS", "gauge"),
+    'player_nbt_info': ("Text playerdata tag selected with PLAYERDATA_TAGS", "gauge"),
+    'player_inventory_items': ("Items of a kind in the inventory of a Player", "gauge"),
+}
+
+# How stats map to metrics, extendable with STAT_MAPPING_FILE.
+# "legacy" maps the second part of pre 1.15 "stat.<stat>.<rest>" keys, "<rest>" becomes the value of "label".
+# "categories" maps the 1.15+ stat categories, their keys become the value of "label".
+# "custom" maps single "minecraft:custom" stats, all others go to "custom_default".
+# "labels" adds fixed labels, dict values of legacy keys get one sample per entry.
+STAT_MAPPINGS = {
+    "legacy": {
+        "mineBlock": {"metric": "blocks_mined", "label": "block"},
+        "pickup": {"metric": "blocks_picked_up", "label": "block"},
+        "entityKilledBy": {"metric": "player_deaths", "label": "cause"},
+        "jump": {"metric": "player_jumps"},
+        "walkOneCm": {"metric": "cm_traveled", "labels": {"method": "walking"}},
+        "swimOneCm": {"metric": "cm_traveled", "labels": {"method": "swimming"}},
+        "sprintOneCm": {"metric": "cm_traveled", "labels": {"method": "sprinting"}},
+        "diveOneCm": {"metric": "cm_traveled", "labels": {"method": "diving"}},
+        "fallOneCm": {"metric": "cm_traveled", "labels": {"method": "falling"}},
+        "flyOneCm": {"metric": "cm_traveled", "labels": {"method": "flying"}},
+        "boatOneCm": {"metric": "cm_traveled", "labels": {"method": "boat"}},
+        "horseOneCm": {"metric": "cm_traveled", "labels": {"method": "horse"}},
+        "climbOneCm": {"metric": "cm_traveled", "labels": {"method": "climbing"}},
+        "XpTotal": {"metric": "player_xp_total"},
+        "XpLevel": {"metric": "player_current_level"},
+        "foodLevel": {"metric": "player_food_level"},
+        "Health": {"metric": "player_health"},
+        "Score": {"metric": "player_score"},
+        "killEntity": {"metric": "entities_killed", "label": "entity"},
+        "damageDealt": {"metric": "damage_dealt"},
+        "damageTaken": {"metric": "damage_taken"},
+        "craftItem": {"metric": "blocks_crafted", "label": "block"},
+        "playOneMinute": {"metric": "player_playtime"},
+        "advancements": {"metric": "player_advancements"},
+        "sleepInBed": {"metric": "player_slept"},
+        "craftingTableInteraction": {"metric": "player_used_crafting_table"},
+        "questsFinished": {"metric": "player_quests_finished"},
+        "questsFinishedByChapter": {"metric": "player_quests_finished_by_chapter", "label": "chapter"},
+        "nbt": {"metric": "player_nbt", "label": "tag"},
+        "nbtInfo": {"metric": "player_nbt_info", "label": "tag", "value_label": "value"},
+        "inventory": {"metric": "player_inventory_items", "label": "item"},
+    },
+    "categories": {
+        "minecraft:crafted": {"metric": "blocks_crafted", "label": "block"},
+        "minecraft:mined": {"metric": "blocks_mined", "label": "block"},
+        "minecraft:picked_up": {"metric": "blocks_picked_up", "label": "block"},
+        "minecraft:killed": {"metric": "entities_killed", "label": "entity"},
+        "minecraft:killed_by": {"metric": "player_deaths", "label": "cause"},
+    },
+    "custom": {
+        "minecraft:jump": {"metric": "player_jumps"},
+        "minecraft:deaths": {"metric": "player_deaths"},
+        "minecraft:damage_taken": {"metric": "damage_taken"},
+        "minecraft:damage_dealt": {"metric": "damage_dealt"},
+        "minecraft:play_time": {"metric": "player_playtime"},
+        "minecraft:play_one_minute": {"metric": "player_playtime"},  # pre 1.17
+        "minecraft:walk_one_cm": {"metric": "cm_traveled", "labels": {"method": "walking"}},
+        "minecraft:walk_on_water_one_cm": {"metric": "cm_traveled", "labels": {"method": "swimming"}},
+        "minecraft:sprint_one_cm": {"metric": "cm_traveled", "labels": {"method": "sprinting"}},
+        "minecraft:walk_under_water_one_cm": {"metric": "cm_traveled", "labels": {"method": "diving"}},
+        "minecraft:fall_one_cm": {"metric": "cm_traveled", "labels": {"method": "falling"}},
+        "minecraft:fly_one_cm": {"metric": "cm_traveled", "labels": {"method": "flying"}},
+        "minecraft:boat_one_cm": {"metric": "cm_traveled", "labels": {"method": "boat"}},
+        "minecraft:horse_one_cm": {"metric": "cm_traveled", "labels": {"method": "horse"}},
+        "minecraft:climb_one_cm": {"metric": "cm_traveled", "labels": {"method": "climbing"}},
+        "minecraft:sleep_in_bed": {"metric": "player_slept"},
+        "minecraft:interact_with_crafting_table": {"metric": "player_used_crafting_table"},
+    },
+    "custom_default": {"metric": "mc_custom", "label": "stat"},
+}
+
+
+def load_stat_mappings(mapping_file):
+    metrics = dict(PLAYER_METRICS)
+    mappings = {section: dict(STAT_MAPPINGS[section]) for section in ("legacy", "categories", "custom")}
+    mappings["custom_default"] = STAT_MAPPINGS["custom_default"]
+    if mapping_file:
+        with open(mapping_file) as json_file:
+            extension = json.load(json_file)
+        for metric, (documentation, typ) in extension.get("metrics", {}).items():
+            metrics[metric] = (documentation, typ)
+        for section in ("legacy", "categories", "custom"):
+            mappings[section].update(extension.get(section, {}))
+        mappings["custom_default"] = extension.get("custom_default", mappings["custom_default"])
+    return metrics, compile_stat_mappings(mappings, metrics)
+
+
+def compile_stat_mapping(mapping, metrics):
+    if mapping["metric"] not in metrics:
+        raise ValueError(f"Stat mapping to unknown metric {mapping['metric']}")
+    return mapping["metric"], mapping.get("label"), mapping.get("labels", {}), mapping.get("value_label")
+
+
+def compile_stat_mappings(mappings, metrics):
+    # section -> stat -> (metric, label, fixed labels, value label), looked up once per stat key
+    compiled = {section: {stat: compile_stat_mapping(mapping, metrics) for stat, mapping in mappings[section].items()}
+                for section in ("legacy", "categories", "custom")}
+    compiled["custom_default"] = compile_stat_mapping(mappings["custom_default"], metrics)
+    return compiled
+
+
+# skips the argument handling of the Sample namedtuple constructor, a third of the cost of building a sample
+new_sample = tuple.__new__
+
+
+def compact_samples(samples):
+    # dormant players keep their samples for a long time, share the label strings between them
+    return {metric: tuple(new_sample(Sample, (sample.name, {k: sys.intern(v) if type(v) is str else v
+                                                          for k, v in sample.labels.items()},
+                                              sample.value, None, None))
+                          for sample in metric_samples)
+            for metric, metric_samples in samples.items()}
+
+
+def add_stat_sample(samples, mapping, player_labels, label_value, value):
+    metric, label, labels, value_label = mapping
+    sample_labels = {**player_labels, **labels}
+    if label is not None:
+        sample_labels[label] = label_value
+    if value_label is not None:
+        sample_labels[value_label] = value
+        value = 1
+    samples.setdefault(metric, []).append(new_sample(Sample, (metric, sample_labels, value, None, None)))
+
+
+def build_player_samples(mappings, name, data, server=None):
+    # returns metric name -> samples of one player
+    samples = dict()
+    player_labels = {'player': name, 'server': server} if server else {'player': name}
+    legacy = mappings["legacy"]
+    for key, value in data.items():  # pre 1.15
+        if key in ("stats", "DataVersion"):
+            continue
+        parts = key.split(".", 2)  # stat.entityKilledBy.minecraft.zombie
+        mapping = legacy.get(parts[1]) if len(parts) > 1 else None
+        if mapping is None:
+            continue
+        if isinstance(value, dict):
+            for label_value, entry_value in value.items():
+                add_stat_sample(samples, mapping, player_labels, label_value, entry_value)
+        else:
+            add_stat_sample(samples, mapping, player_labels, parts[2] if len(parts) > 2 else None, value)
+
+    if "stats" in data:  # Minecraft > 1.15
+        categories = mappings["categories"]
+        custom = mappings["custom"]
+        custom_default = mappings["custom_default"]
+        for category, stats in data["stats"].items():
+            if category == "minecraft:custom":
+                for stat, value in stats.items():
+                    add_stat_sample(samples, custom.get(stat, custom_default), player_labels, stat, value)
+                continue
+            mapping = categories.get(category)
+            if mapping is None:
+                continue
+            # categories hold most samples of a player, keep their loop tight
+            metric, label, labels, value_label = mapping
+            if label is None or value_label is not None:
+                for key, value in stats.items():
+                    add_stat_sample(samples, mapping, player_labels, key, value)
+                continue
+            append = samples.setdefault(metric, []).append
+            if labels or server:
+                sample_labels = {**player_labels, **labels}
+                for key, value in stats.items():
+                    append(new_sample(Sample, (metric, {**sample_labels, label: key}, value, None, None)))
+            else:
+                for key, value in stats.items():
+                    append(new_sample(Sample, (metric, {'player': name, label: key}, value, None, None)))
+    return samples
+
+
+# metric -> label holding the block, item, entity or stat id that cardinality limits apply to
+CARDINALITY_LABELS = {
+    'blocks_mined': 'block',
+    'blocks_picked_up': 'block',
+    'blocks_crafted': 'block',
+    'entities_killed': 'entity',
+    'player_deaths': 'cause',
+    'mc_custom': 'stat',
+    'player_inventory_items': 'item',
+}
+
+
+def parse_top_k(spec):
+    # "20" limits every metric of CARDINALITY_LABELS, "blocks_mined=50,mc_custom=10" single metrics
+    top_k = dict()
+    for entry in spec.split(","):
+        if "=" in entry:
+            metric, k = entry.split("=", 1)
+            top_k[metric.strip()] = int(k)
+        elif entry.strip():
+            top_k.update({metric: int(entry) for metric in CARDINALITY_LABELS if metric not in top_k})
+    return top_k
+
+
+def namespace_of(value):
+    # minecraft:stone, pre 1.13 minecraft.stone and pre 1.13 entities like Zombie without namespace
+    for separator in (":", "."):
+        if separator in value:
+            return value.split(separator, 1)[0]
+    return "minecraft"
+
+
+def add_server_label(metrics, server):
+    for metric in metrics:
+        metric.samples = [new_sample(Sample, (sample.name, {**sample.labels, 'server': server}, sample.value,
+                                              sample.timestamp, sample.exemplar))
+                          for sample in metric.samples]
+    return metrics
+
 
-    def rcon_connect(self):
+def merge_metrics(metrics):
+    # families of the same name from several servers have to be exposed as one
+    families = dict()
+    for metric in metrics:
+        family = families.get(metric.name)
+        if family is None:
+            family = families[metric.name] = Metric(metric.name, metric.documentation, metric.type)
+        family.samples.extend(metric.samples)
+    return list(families.values())
+
+
+def limit_player_samples(samples, top_k, allow, deny, aggregate):
+    # returns (samples, aggregates, dropped): the samples within the limits, metric -> label value -> value summed
+    # into the server wide aggregates and metric -> number of series dropped or folded into "other"
+    limited = dict(samples)
+    aggregates = dict()
+    dropped = dict()
+    for metric, label in CARDINALITY_LABELS.items():
+        if metric not in samples:
+            continue
+        kept = []
+        limitable = []
+        for sample in samples[metric]:
+            value = sample.labels.get(label)
+            if value is None:
+                kept.append(sample)
+            elif allow and namespace_of(value) not in allow or deny and namespace_of(value) in deny:
+                dropped[metric] = dropped.get(metric, 0) + 1
+            else:
+                limitable.append(sample)
+        if metric in aggregate:
+            totals = aggregates[metric] = dict()
+            for sample in limitable:
+                totals[sample.labels[label]] = totals.get(sample.labels[label], 0) + sample.value
+        k = top_k.get(metric)
+        if k is not None and len(limitable) > k:
+            limitable.sort(key=lambda s: s.value, reverse=True)
+            other = limitable[k:]
+            limitable = limitable[:k]
+            labels = dict(other[0].labels)
+            labels[label] = "other"
+            limitable.append(new_sample(Sample, (metric, labels, sum(s.value for s in other), None, None)))
+            dropped[metric] = dropped.get(metric, 0) + len(other) - 1
+        limited[metric] = kept + limitable
+    return limited, aggregates, dropped
+
+
+class StaticCollector(object):
+    # lets generate_latest render metrics that are not registered anywhere
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        return self.metrics
+
+
+def render_family_header(metric, documentation, typ):
+    return generate_latest(StaticCollector([Metric(metric, documentation, typ)]))
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def render_samples(samples):
+    # same text as generate_latest produces for these samples, without the family header
+    lines = []
+    for name, labels, value, _, _ in samples:
+        if labels:
+            label_string = ",".join(f'{k}="{escape_label_value(v)}"' for k, v in sorted(labels.items()))
+            lines.append(f"{name}{{{label_string}}} {floatToGoString(value)}\n")
+        else:
+            lines.append(f"{name} {floatToGoString(value)}\n")
+    return "".join(lines).encode('utf-8')
+
+
+class Fragment(object):
+    # rendered text of a scrape body with its digest and a gzip member made on first request
+    def __init__(self, text):
+        self.text = text
+        self.digest = hashlib.blake2b(text, digest_size=16).digest()
+        self.compressed = None
+
+    def gzipped(self):
+        if self.compressed is None:
+            self.compressed = gzip.compress(self.text, compresslevel=6)
+        return self.compressed
+
+
+class Exposition(object):
+    # a scrape body made of fragments, gzip members can be concatenated so every fragment is compressed only once
+    def __init__(self, fragments, families=()):
+        self.fragments = fragments
+        # the rendered player families the first fragment was joined from
+        self.families = families
+        self.etag = '"' + hashlib.blake2b(b"".join(f.digest for f in fragments), digest_size=16).hexdigest() + '"'
+
+    def chunks(self, compressed):
+        return [f.gzipped() if compressed else f.text for f in self.fragments]
+
+
+class ExpositionHandler(BaseHTTPRequestHandler):
+    collector = None
+
+    def do_GET(self):
         try:
-            self.rcon.__enter__() # https://github.com/conqp/mcipc/issues/16
-            self.rcon_connected = True
-            print("Successfully connected to RCON")
-            return True
+            exposition = self.collector.exposition()
         except Exception as e:
-            print("Failed to connect to RCON")
-            print(e)
-        return False
+            print("Collection failed:", repr(e))
+            self.send_error(500)
+            return
+        if exposition.etag in [t.strip() for t in self.headers.get('If-None-Match', "").split(",")]:
+            self.send_response(304)
+            self.send_header('ETag', exposition.etag)
+            self.end_headers()
+            return
+        compressed = 'gzip' in self.headers.get('Accept-Encoding', "")
+        chunks = exposition.chunks(compressed)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('ETag', exposition.etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(sum(len(chunk) for chunk in chunks)))
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def assemble_exposition(family_headers, parts, previous=None):
+    # parts are (metric -> rendered player samples, other metrics) of one collection per server, the players of
+    # the previous Exposition are reused as long as no player changed
+    families = tuple(families for families, _ in parts)
+    if previous is not None and len(previous.families) == len(families) and \
+            all(a is b for a, b in zip(previous.families, families)):
+        players = previous.fragments[0]
+    else:
+        players = Fragment(b"".join(header + b"".join(f[metric] for f in families if metric in f)
+                                    for metric, header in family_headers.items()))
+    metrics = merge_metrics(metric for _, metrics in parts for metric in metrics)
+    # self instrumentation is taken when the body is assembled, so unchanged snapshots keep their ETag
+    return Exposition((players, Fragment(generate_latest(StaticCollector(metrics)) + generate_latest(REGISTRY))),
+                      families)
 
-    def rcon_disconnect(self):
-        self.rcon.close()
-        self.rcon_connected = False
 
-    def rcon_command(self, command):
+def start_exposition_server(port, collector):
+    handler = type('ExpositionHandler', (ExpositionHandler,), {'collector': collector})
+    server = ThreadingHTTPServer(('', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="exposition-server", daemon=True).start()
+    return server
+
+
+class PlayerNameResolver(object):
+    def __init__(self, cache_file, usercache_file, ttl, lookups_per_second, session_url):
+        self.cache_file = cache_file
+        self.usercache_file = usercache_file
+        self.ttl = ttl
+        self.lookup_interval = 1.0 / lookups_per_second
+        self.session_url = session_url
+        self.timeout = 5
+        self.rate_limit_backoff = 60
+
+        # uuid -> (name, expires), name is None if Mojang does not know the uuid
+        self.names = dict()
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.worker = None
+
+        self.load_cache()
+        self.load_usercache()
+
+    def load_cache(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return
         try:
-            response = self.rcon.run(command)
+            with open(self.cache_file) as json_file:
+                entries = json.load(json_file)
+            with self.lock:
+                for uuid, entry in entries.items():
+                    self.names[uuid] = (entry["name"], entry["expires"])
+            print(f"Loaded {len(entries)} player names from {self.cache_file}")
         except Exception as e:
-            response = None
-            if e == "Connection timeout error":
-                print("Lost RCON Connection")
-                self.rcon_disconnect()
-            else:
-                print("RCON command failed:",e)
-        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
-            print("Lost RCON Connection")
-            self.rcon_disconnect()
-            response = None
+            print("Failed to load player name cache:", e)
+            ERRORS.labels('name_cache').inc()
 
+    def load_usercache(self, usercache_file=None):
+        # usercache.json of the server knows everyone who joined recently
+        usercache_file = usercache_file or self.usercache_file
+        if not usercache_file or not os.path.isfile(usercache_file):
+            return
+        try:
+            with open(usercache_file) as json_file:
+                usercache = json.load(json_file)
+        except Exception as e:
+            print("Failed to load usercache:", e)
+            ERRORS.labels('name_cache').inc()
+            return
+        expires = time.time() + self.ttl
+        # runs on the scheduler thread while the worker may be saving the cache
+        with self.lock:
+            for entry in usercache:
+                cached = self.names.get(entry["uuid"])
+                # names still listed by the server stay fresh without asking Mojang
+                if cached is None or cached[0] != entry["name"] or cached[1] < expires:
+                    self.names[entry["uuid"]] = (entry["name"], expires)
+
+    def save_cache(self):
+        if not self.cache_file:
+            return
+        with self.lock:
+            entries = {uuid: {"name": name, "expires": expires} for uuid, (name, expires) in self.names.items()}
+        try:
+            with open(self.cache_file + ".tmp", "w") as json_file:
+                json.dump(entries, json_file)
+            os.replace(self.cache_file + ".tmp", self.cache_file)
+        except Exception as e:
+            print("Failed to save player name cache:", e)
+            ERRORS.labels('name_cache').inc()
+
+    def get(self, uuid):
+        cached = self.names.get(uuid)
+        if cached is None or cached[1] < time.time():
+            CACHE_REQUESTS.labels('name', 'miss').inc()
+            self.request(uuid)
+        else:
+            CACHE_REQUESTS.labels('name', 'hit').inc()
+        # expired names are still served until the lookup has finished
+        return cached[0] if cached is not None else None
+
+    def request(self, uuid):
+        with self.lock:
+            if uuid in self.pending:
+                return
+            self.pending.add(uuid)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name="name-resolver", daemon=True)
+                self.worker.start()
+        self.queue.put(uuid)
+
+    def lookup(self, uuid):
+        with NAME_LOOKUP_DURATION.time():
+            response = self.session.get(self.session_url + uuid.replace("-", ""), timeout=self.timeout)
+        if response.status_code in (204, 404):
+            return None
+        response.raise_for_status()
+        return response.json()["name"]
+
+    def run(self):
+        while True:
+            uuid = self.queue.get()
+            backoff = self.lookup_interval
+            try:
+                name = self.lookup(uuid)
+                with self.lock:
+                    self.names[uuid] = (name, time.time() + self.ttl)
+            except Exception as e:
+                print(f"Failed to resolve player name for {uuid}:", e)
+                ERRORS.labels('name_lookup').inc()
+                if isinstance(e, requests.HTTPError) and e.response.status_code == 429:
+                    backoff = self.rate_limit_backoff
+            finally:
+                with self.lock:
+                    self.pending.discard(uuid)
+            # the worker is never started again, nothing may end it
+            try:
+                if self.queue.empty():
+                    self.save_cache()
+            except Exception as e:
+                print("Failed to save player name cache:", repr(e))
+                ERRORS.labels('name_cache').inc()
+            time.sleep(backoff)
+
+
+class RconSession(object):
+    def __init__(self, host, port, passwd, connections, timeout, socket_timeout, cache_ttl):
+        self.host = host
+        self.port = port
+        self.passwd = passwd
+        self.timeout = timeout
+        self.socket_timeout = socket_timeout
+        self.cache_ttl = cache_ttl
+
+        # logged in clients that are not running a command right now
+        self.idle = queue.LifoQueue()
+        self.executor = ThreadPoolExecutor(max_workers=connections, thread_name_prefix="rcon")
+        # command -> (timestamp, response) and command -> Future of the command still running
+        self.responses = dict()
+        self.running = dict()
+        # futures a scrape stopped waiting for, and command -> their response, served once to the next scrape
+        self.missed = set()
+        self.late = dict()
+        self.lock = threading.RLock()
+        self.failures = 0
+        self.retry_at = 0
+
+    def available(self):
+        return time.time() >= self.retry_at
+
+    def connect(self):
+        if not self.available():
+            raise ConnectionError(f"RCON reconnect backoff for {self.retry_at - time.time():.0f} more seconds")
+        client = Client(self.host, self.port, timeout=self.socket_timeout, passwd=self.passwd)
+        try:
+            client.__enter__()  # https://github.com/conqp/mcipc/issues/16
+        except Exception:
+            client.close()
+            self.connection_failed()
+            raise
+        if self.failures:
+            print("Successfully reconnected to RCON")
+        self.failures = 0
+        return client
+
+    def connection_failed(self):
+        with self.lock:
+            self.failures += 1
+            self.retry_at = time.time() + min(60, 2 ** self.failures)
+
+    def close_idle(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def execute(self, command):
+        try:
+            client = self.idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            client = self.connect()
+            reused = False
+        try:
+            with RCON_COMMAND_DURATION.labels(command).time():
+                response = client.run(command)
+        except Exception:
+            # the connection is in an unknown state, drop it together with its idle siblings
+            client.close()
+            self.close_idle()
+            if reused:
+                # idle connections may have died with a server restart, retry once on a new one
+                return self.execute(command)
+            self.connection_failed()
+            raise
+        self.idle.put(client)
         return response
 
+    def finished(self, command, future):
+        with self.lock:
+            del self.running[command]
+            missed = future in self.missed
+            self.missed.discard(future)
+            if future.exception() is None:
+                self.responses[command] = (time.time(), future.result())
+                if missed:
+                    self.late[command] = future.result()
+            else:
+                print(f"RCON command {command} failed: {future.exception()!r}")
+                ERRORS.labels('rcon').inc()
+
+    def submit(self, command):
+        # returns (cached response, None) or (late response or None, Future of the running command)
+        with self.lock:
+            cached = self.responses.get(command)
+            if cached is not None and time.time() - cached[0] < self.cache_ttl:
+                CACHE_REQUESTS.labels('rcon', 'hit').inc()
+                return cached[1], None
+            CACHE_REQUESTS.labels('rcon', 'miss').inc()
+            future = self.running.get(command)
+            if future is None:
+                future = self.executor.submit(self.execute, command)
+                self.running[command] = future
+                # runs right away if the command already failed, eg on a refused connection
+                future.add_done_callback(partial(self.finished, command))
+            return self.late.pop(command, None), future
+
+    def run(self, *commands):
+        # commands run concurrently, a command that misses its deadline keeps running and its response is
+        # served to the next run, or from the cache for RCON_CACHE_TTL
+        submitted = [self.submit(command) for command in commands]
+        deadline = time.time() + self.timeout
+        responses = []
+        for response, future in submitted:
+            if future is None:
+                responses.append(response)
+                continue
+            try:
+                responses.append(future.result(timeout=max(0.0, deadline - time.time())))
+            except Exception:
+                with self.lock:
+                    if not future.done():
+                        self.missed.add(future)
+                responses.append(response)
+        return responses
+
+
+# chunk tags up to 1.17 (Level), block entities since 1.18 and the entities region files since 1.17
+CHUNK_TAGS = nbt_paths(["Level.Entities.id", "Level.TileEntities.id", "block_entities.id", "Entities.id"])
+REGION_FILE = re.compile(r"r\.(-?\d+)\.(-?\d+)\.mca$")
+REGION_HEADER = struct.Struct(">1024I")
+CHUNK_HEADER = struct.Struct(">IB")
+INDEX_VERSION = 2
+
+
+def count_ids(entries, counts):
+    for entry in entries:
+        entity_id = entry.get("id", "unknown") if isinstance(entry, dict) else "unknown"
+        counts[entity_id] = counts.get(entity_id, 0) + 1
+    return counts
+
+
+def read_chunk(region_file, directory, x, z, offset):
+    # returns the decoded chunk at offset of a region file, the server may truncate or rewrite it meanwhile
+    region_file.seek(offset)
+    header = region_file.read(CHUNK_HEADER.size)
+    if len(header) < CHUNK_HEADER.size:
+        raise EOFError(f"Chunk header at {offset} is past the end of the region file")
+    length, compression = CHUNK_HEADER.unpack(header)
+    data = region_file.read(max(0, length - 1))
+    if len(data) < length - 1:
+        raise EOFError(f"Chunk at {offset} is cut off after {len(data)} of {length - 1} bytes")
+    if compression & 128:  # stored in its own file for being larger than 1 MiB
+        data = read_file(join(directory, f"c.{x}.{z}.mcc"))
+        compression &= 127
+    FILE_READ_BYTES.labels('region').inc(len(data))
+    if compression in (1, 2):
+        return read_nbt_bytes(data, CHUNK_TAGS)
+    if compression == 3:
+        return read_nbt(data, CHUNK_TAGS)
+    raise ValueError(f"Unsupported chunk compression {compression}")  # eg LZ4 of 1.20.5
+
+
+def count_chunk(chunk):
+    level = chunk.get("Level", {})
+    entities = count_ids(level.get("Entities", ()), dict())
+    count_ids(chunk.get("Entities", ()), entities)
+    tile_entities = count_ids(level.get("TileEntities", ()), dict())
+    count_ids(chunk.get("block_entities", ()), tile_entities)
+    return entities, tile_entities
+
+
+def dimension_directories(world_directory):
+    # returns dimension name -> directory holding its region and entities folders
+    dimensions = {"minecraft:overworld": world_directory}
+    for name in listdir(world_directory):
+        if name == "DIM-1":
+            dimensions["minecraft:the_nether"] = join(world_directory, name)
+        elif name == "DIM1":
+            dimensions["minecraft:the_end"] = join(world_directory, name)
+        elif re.match(r"DIM-?\d+$", name):  # forge dimensions before 1.16
+            dimensions[name] = join(world_directory, name)
+    custom = join(world_directory, "dimensions")
+    if os.path.isdir(custom):
+        for namespace in listdir(custom):
+            if not os.path.isdir(join(custom, namespace)):
+                continue
+            for dimension in listdir(join(custom, namespace)):
+                if (namespace, dimension) not in (("minecraft", "overworld"), ("minecraft", "the_nether"),
+                                                  ("minecraft", "the_end")):
+                    dimensions[namespace + ":" + dimension] = join(custom, namespace, dimension)
+    return dimensions
+
+
+class WorldScanner(object):
+    # counts chunks, entities and tile entities of all region files, only chunks whose location or
+    # timestamp changed are decoded again, the counts of all others come from a persistent index with
+    # one file per region, so a scan only writes the regions that changed
+    def __init__(self, world_directory, index_directory, interval, top_chunks, chunks_per_second, server=""):
+        self.world_directory = world_directory
+        self.index_directory = index_directory
+        self.interval = interval
+        self.top_chunks = top_chunks
+        self.chunk_interval = 1.0 / chunks_per_second if chunks_per_second > 0 else 0
+        self.server = server
+
+        # region path -> {"fingerprint", "dimension", "x", "z", "chunks": {index: [location, timestamp, entities,
+        # tile_entities]}}, and region path -> summary of its counts
+        self.regions = dict()
+        self.summaries = dict()
+        # (chunks, entities, tile_entities, top entity chunks, top tile entity chunks) of the last scan
+        self.results = None
+        self.next_decode = 0.0
+
+        self.load_index()
+
+    def index_path(self, path):
+        return join(self.index_directory, hashlib.blake2b(path.encode(), digest_size=16).hexdigest() + ".json")
+
+    def load_index(self):
+        if not self.index_directory or not os.path.isdir(self.index_directory):
+            return
+        for name in listdir(self.index_directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(join(self.index_directory, name)) as json_file:
+                    index = json.load(json_file)
+                if index.get("version") != INDEX_VERSION:
+                    continue
+                region = index["region"]
+                region["chunks"] = {int(i): chunk for i, chunk in region["chunks"].items()}
+                self.regions[index["path"]] = region
+                self.summaries[index["path"]] = self.summarize(region)
+            except Exception as e:
+                # the region is scanned again
+                print(f"Failed to load world scan index {name}:", repr(e))
+                ERRORS.labels('world_scan').inc()
+        print(f"Loaded {len(self.regions)} regions from {self.index_directory}")
+
+    def save_region(self, path):
+        if not self.index_directory:
+            return
+        index_path = self.index_path(path)
+        try:
+            os.makedirs(self.index_directory, exist_ok=True)
+            with open(index_path + ".tmp", "w") as json_file:
+                json.dump({"version": INDEX_VERSION, "path": path, "region": self.regions[path]}, json_file)
+            os.replace(index_path + ".tmp", index_path)
+        except Exception as e:
+            print(f"Failed to save world scan index of {path}:", repr(e))
+            ERRORS.labels('world_scan').inc()
+
+    def remove_region(self, path):
+        if not self.index_directory:
+            return
+        try:
+            os.remove(self.index_path(path))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Failed to remove world scan index of {path}:", repr(e))
+            ERRORS.labels('world_scan').inc()
+
+    def region_files(self):
+        # yields (path, dimension, region x, region z)
+        for dimension, directory in dimension_directories(self.world_directory).items():
+            for folder in ("region", "entities"):
+                folder = join(directory, folder)
+                if not os.path.isdir(folder):
+                    continue
+                for name in listdir(folder):
+                    match = REGION_FILE.match(name)
+                    if match:
+                        yield join(folder, name), dimension, int(match.group(1)), int(match.group(2))
+
+    def throttle(self):
+        # spreads decoding out so scans do not compete with scrapes for the interpreter
+        if not self.chunk_interval:
+            return
+        now = time.monotonic()
+        if self.next_decode > now:
+            time.sleep(self.next_decode - now)
+        self.next_decode = max(self.next_decode, now) + self.chunk_interval
+
+    def scan_region(self, path, dimension, region_x, region_z, previous):
+        chunks = dict()
+        with open(path, "rb") as region_file:
+            # only the headers are read up front, the changed chunks are read one by one, a file truncated
+            # meanwhile then fails a read instead of faulting on a memory mapping
+            header = region_file.read(8192)
+            if len(header) < 8192:
+                return chunks
+            locations = REGION_HEADER.unpack_from(header, 0)
+            timestamps = REGION_HEADER.unpack_from(header, 4096)
+            for i, location in enumerate(locations):
+                if not location:
+                    continue
+                # timestamps only have a resolution of seconds, a moved or resized chunk changes its location too
+                cached = previous.get(i)
+                if cached is not None and cached[0] == location and cached[1] == timestamps[i]:
+                    CACHE_REQUESTS.labels('chunk', 'hit').inc()
+                    chunks[i] = cached
+                    continue
+                CACHE_REQUESTS.labels('chunk', 'miss').inc()
+                self.throttle()
+                x, z = region_x * 32 + i % 32, region_z * 32 + i // 32
+                try:
+                    chunk = read_chunk(region_file, os.path.dirname(path), x, z, (location >> 8) * 4096)
+                except Exception as e:
+                    print(f"Failed to read chunk {x}, {z} of {path}:", repr(e))
+                    ERRORS.labels('world_scan').inc()
+                    chunk = None
+                entities, tile_entities = count_chunk(chunk) if chunk is not None else (dict(), dict())
+                chunks[i] = [location, timestamps[i], entities, tile_entities]
+        return chunks
+
+    def summarize(self, region):
+        # (chunks, dimension, entities, tile_entities, top entity chunks, top tile entity chunks) of one region
+        entities = dict()
+        tile_entities = dict()
+        top_entities = []
+        top_tile_entities = []
+        for i, (_, _, chunk_entities, chunk_tile_entities) in region["chunks"].items():
+            position = (region["x"] * 32 + i % 32, region["z"] * 32 + i // 32)
+            for entity_id, count in chunk_entities.items():
+                entities[entity_id] = entities.get(entity_id, 0) + count
+            for entity_id, count in chunk_tile_entities.items():
+                tile_entities[entity_id] = tile_entities.get(entity_id, 0) + count
+            if chunk_entities:
+                top_entities.append((sum(chunk_entities.values()), position))
+            if chunk_tile_entities:
+                top_tile_entities.append((sum(chunk_tile_entities.values()), position))
+        # entities region files only hold entities, the chunks are counted from the block region files
+        chunks = 0 if region["entities"] else len(region["chunks"])
+        return (chunks, region["dimension"], entities, tile_entities,
+                heapq.nlargest(self.top_chunks, top_entities), heapq.nlargest(self.top_chunks, top_tile_entities))
+
+    def scan(self):
+        changed = False
+        seen = set()
+        for path, dimension, region_x, region_z in self.region_files():
+            seen.add(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            fingerprint = [stat.st_mtime_ns, stat.st_size]
+            region = self.regions.get(path)
+            if region is not None and region["fingerprint"] == fingerprint:
+                continue
+            try:
+                chunks = self.scan_region(path, dimension, region_x, region_z,
+                                          region["chunks"] if region is not None else dict())
+            except Exception as e:
+                print(f"Failed to scan region {path}:", repr(e))
+                ERRORS.labels('world_scan').inc()
+                continue
+            region = {"fingerprint": fingerprint, "dimension": dimension, "x": region_x, "z": region_z,
+                      "entities": os.path.basename(os.path.dirname(path)) == "entities", "chunks": chunks}
+            self.regions[path] = region
+            self.summaries[path] = self.summarize(region)
+            self.save_region(path)
+            changed = True
+        for path in set(self.regions) - seen:
+            del self.regions[path]
+            del self.summaries[path]
+            self.remove_region(path)
+            changed = True
+
+        if changed or self.results is None:
+            self.results = self.aggregate()
+
+    def aggregate(self):
+        chunks = dict()
+        entities = dict()
+        tile_entities = dict()
+        top_entities = []
+        top_tile_entities = []
+        for region_chunks, dimension, region_entities, region_tile_entities, region_top_entities, \
+                region_top_tile_entities in self.summaries.values():
+            chunks[dimension] = chunks.get(dimension, 0) + region_chunks
+            for entity_id, count in region_entities.items():
+                entities[dimension, entity_id] = entities.get((dimension, entity_id), 0) + count
+            for entity_id, count in region_tile_entities.items():
+                tile_entities[dimension, entity_id] = tile_entities.get((dimension, entity_id), 0) + count
+            top_entities.extend((count, dimension, position) for count, position in region_top_entities)
+            top_tile_entities.extend((count, dimension, position) for count, position in region_top_tile_entities)
+        # the densest chunks overall are among the densest chunks of each region
+        return (chunks, entities, tile_entities, heapq.nlargest(self.top_chunks, top_entities),
+                heapq.nlargest(self.top_chunks, top_tile_entities))
+
+    def run(self):
+        while True:
+            started = time.time()
+            try:
+                with WORLD_SCAN_DURATION.labels(self.server).time():
+                    self.scan()
+            except Exception as e:
+                print("World scan failed:", repr(e))
+                ERRORS.labels('world_scan').inc()
+            time.sleep(max(0.0, self.interval - (time.time() - started)))
+
+    def start(self):
+        print(f"Scanning region files of {self.world_directory} every {self.interval} seconds")
+        threading.Thread(target=self.run, name=f"world-scanner-{self.server}", daemon=True).start()
+
+    def get_metrics(self):
+        results = self.results
+        if results is None:
+            return []
+        chunks, entities, tile_entities, top_entities, top_tile_entities = results
+        world_chunks = Metric('world_chunks', 'Chunks saved in the region files of a dimension', "gauge")
+        world_entities = Metric('world_entities', 'Entities saved in a dimension by type', "gauge")
+        world_tile_entities = Metric('world_tile_entities', 'Tile entities saved in a dimension by type', "gauge")
+        chunk_entities = Metric('world_chunk_entities', 'Entities of the chunks with the most entities', "gauge")
+        chunk_tile_entities = Metric('world_chunk_tile_entities',
+                                     'Tile entities of the chunks with the most tile entities', "gauge")
+        for dimension, count in chunks.items():
+            world_chunks.add_sample('world_chunks', value=count, labels={'dimension': dimension})
+        for (dimension, entity), count in entities.items():
+            world_entities.add_sample('world_entities', value=count, labels={'dimension': dimension, 'entity': entity})
+        for (dimension, entity), count in tile_entities.items():
+            world_tile_entities.add_sample('world_tile_entities', value=count,
+                                           labels={'dimension': dimension, 'tile_entity': entity})
+        for count, dimension, (x, z) in top_entities:
+            chunk_entities.add_sample('world_chunk_entities', value=count,
+                                      labels={'dimension': dimension, 'x': str(x), 'z': str(z)})
+        for count, dimension, (x, z) in top_tile_entities:
+            chunk_tile_entities.add_sample('world_chunk_tile_entities', value=count,
+                                           labels={'dimension': dimension, 'x': str(x), 'z': str(z)})
+        return [world_chunks, world_entities, world_tile_entities, chunk_entities, chunk_tile_entities]
+
+
+def create_name_resolver(environment, usercache_file):
+    return PlayerNameResolver(environment.get('NAME_CACHE_FILE', "playernames.json"), usercache_file,
+                              float(environment.get('NAME_CACHE_TTL', 7 * 24 * 3600)),
+                              float(environment.get('NAME_LOOKUPS_PER_SECOND', 2)),
+                              environment.get('MOJANG_SESSION_URL', MOJANG_SESSION_URL))
+
+
+def create_parse_pool(environment):
+    workers = int(environment.get('PARSE_WORKERS', 1))
+    if workers <= 1:
+        return None
+    print(f"Parsing players with {workers} workers")
+    if environment.get('PARSE_POOL', "thread") == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+class MinecraftCollector(object):
+    def __init__(self, settings=None, player_names=None, parse_pool=None):
+        # settings of one server in multi server mode, they override the environment variables of the same name
+        environment = dict(os.environ)
+        self.server = ""
+        if settings is not None:
+            environment.update({key: str(value) for key, value in settings.items()})
+            self.server = settings['name']
+        self.server_labels = {'server': self.server} if self.server else {}
+
+        world_directory = environment.get('WORLD_DIR', "/world")
+        self.stats_directory = join(world_directory, "stats")
+        self.player_directory = join(world_directory, "playerdata")
+        self.advancements_directory = join(world_directory, "advancements")
+        self.better_questing = join(world_directory, "betterquesting")
+        self.player_names = player_names
+        if player_names is None:
+            self.player_names = create_name_resolver(environment, environment.get('USERCACHE_FILE', "/usercache.json"))
+            schedule.every().day.at("01:00").do(self.player_names.load_usercache)
+        self.quests_enabled = False
+        self.quest_fingerprint = None
+        self.quests_finished = dict()
+        self.quests_finished_by_chapter = dict()
+        self.quest_completions = dict()
+
+        self.player_metrics, self.stat_mappings = load_stat_mappings(environment.get('STAT_MAPPING_FILE'))
+
+        # uuid -> (fingerprint, samples), least recently used first
+        self.player_cache = OrderedDict()
+        self.player_cache_size = int(environment.get('PLAYER_CACHE_SIZE', 10000))
+
+        self.top_k = parse_top_k(environment.get('CARDINALITY_TOP_K', ""))
+        self.namespace_allow = frozenset(n for n in environment.get('NAMESPACE_ALLOW', "").split(",") if n)
+        self.namespace_deny = frozenset(n for n in environment.get('NAMESPACE_DENY', "").split(",") if n)
+        aggregates = environment.get('SERVER_AGGREGATES', "")
+        self.server_aggregates = frozenset(CARDINALITY_LABELS if aggregates == "True" else
+                                           (m for m in aggregates.split(",") if m in CARDINALITY_LABELS))
+        self.cardinality_limited = bool(self.top_k or self.namespace_allow or self.namespace_deny or
+                                        self.server_aggregates)
+        # uuid -> (aggregates, dropped) of every player as returned by limit_player_samples, and their sums
+        self.player_contributions = dict()
+        self.server_totals = dict()
+        self.dropped_totals = dict()
+
+        # players that were not online or changed within the window are only refreshed every interval
+        self.dormant_refresh_interval = float(environment.get('DORMANT_REFRESH_INTERVAL', 0))
+        self.active_player_window = float(environment.get('ACTIVE_PLAYER_WINDOW', 3600))
+        self.online_players = set()
+        # uuid -> time the player was last online or changed, uuid -> time the player is due for a refresh
+        self.player_last_active = dict()
+        self.player_refresh_due = dict()
+        self.compacted_players = set()
+
+        # uuid -> (samples, metric -> rendered samples) and the player part of the last rendered body
+        self.prerender = 'PRERENDER' in environment and environment['PRERENDER'] == "True"
+        self.family_headers = {metric: render_family_header(metric, documentation, typ)
+                               for metric, (documentation, typ) in self.player_metrics.items()}
+        self.player_fragments = dict()
+        self.player_body = ([], dict())
+        self.exposition_cache = (None, None)
+
+        # (timestamp, metrics or Exposition) of the last background collection
+        self.snapshot = None
+        self.snapshot_interval = float(environment.get('SNAPSHOT_INTERVAL', 0))
+        self.collect_lock = threading.Lock()
+
+        self.profile_requested = False
+        self.profile_directory = environment.get('PROFILE_DIR')
+
+        self.playerdata_tags = tuple(t for t in environment.get('PLAYERDATA_TAGS', "").split(",") if t)
+        self.inventory_items = frozenset(i for i in environment.get('PLAYERDATA_INVENTORY_ITEMS', "").split(",") if i)
+
+        self.parse_workers = int(environment.get('PARSE_WORKERS', 1))
+        self.parse_pool = parse_pool if parse_pool is not None else create_parse_pool(environment)
+
+        self.rcon = None
+        if all(x in environment for x in ['RCON_HOST', 'RCON_PASSWORD']):
+            self.rcon = RconSession(environment['RCON_HOST'], int(environment['RCON_PORT']),
+                                    environment['RCON_PASSWORD'],
+                                    int(environment.get('RCON_CONNECTIONS', 2)),
+                                    float(environment.get('RCON_TIMEOUT', 5)),
+                                    float(environment.get('RCON_SOCKET_TIMEOUT', 30)),
+                                    float(environment.get('RCON_CACHE_TTL', 0)))
+            print("RCON is enabled for " + environment['RCON_HOST'])
+        self.world_scanner = None
+        world_scan_interval = float(environment.get('WORLD_SCAN_INTERVAL', 0))
+        if world_scan_interval > 0:
+            self.world_scanner = WorldScanner(world_directory,
+                                              environment.get('WORLD_SCAN_INDEX_DIR',
+                                                              f"worldscan-{self.server}" if self.server
+                                                              else "worldscan"),
+                                              world_scan_interval,
+                                              int(environment.get('WORLD_SCAN_TOP_CHUNKS', 10)),
+                                              float(environment.get('WORLD_SCAN_CHUNKS_PER_SECOND', 500)),
+                                              self.server)
+        self.paper_server = 'PAPER_SERVER' in environment and environment['PAPER_SERVER'] == "True"
+        self.forge_server = 'FORGE_SERVER' in environment and environment['FORGE_SERVER'] == "True"
+        self.dynmap_enabled = 'DYNMAP_ENABLED' in environment and environment['DYNMAP_ENABLED'] == "True"
+
+        if os.path.isdir(self.better_questing):
+            self.quests_enabled = True
+
+    def get_players(self):
+        return [f[:-5] for f in listdir(self.stats_directory) if isfile(join(self.stats_directory, f))]
+
+    def player_files(self, uuid):
+        return (self.stats_directory + "/" + uuid + ".json",
+                self.player_directory + "/" + uuid + ".dat",
+                self.advancements_directory + "/" + uuid + ".json")
+
+    def player_fingerprint(self, uuid):
+        fingerprint = tuple(file_fingerprint(f) for f in self.player_files(uuid))
+        if self.quests_enabled:
+            fingerprint += (self.get_player_quests_finished(uuid),
+                            tuple(sorted(self.quests_finished_by_chapter.get(uuid, {}).items())))
+        return fingerprint
+
+    def get_cached_player_samples(self, uuid, fingerprint):
+        cached = self.player_cache.get(uuid)
+        if cached is None or cached[0] != fingerprint:
+            return None
+        self.player_cache.move_to_end(uuid)
+        return cached[1]
+
+    def cache_player_samples(self, uuid, fingerprint, samples):
+        self.player_cache[uuid] = (fingerprint, samples)
+        self.compacted_players.discard(uuid)
+        self.player_cache.move_to_end(uuid)
+        while len(self.player_cache) > self.player_cache_size:
+            self.player_cache.popitem(last=False)
+
+    def evict_missing_players(self, players):
+        players = set(players)
+        for uuid in set(self.player_cache) - players:
+            del self.player_cache[uuid]
+        for uuid in set(self.player_refresh_due) - players:
+            del self.player_refresh_due[uuid]
+        for uuid in set(self.player_last_active) - players:
+            del self.player_last_active[uuid]
+        for uuid in set(self.player_contributions) - players:
+            self.set_player_contribution(uuid, None)
+        for uuid in set(self.player_fragments) - players:
+            del self.player_fragments[uuid]
+        self.compacted_players &= players
+
+    def add_contribution(self, contribution, sign):
+        aggregates, dropped = contribution
+        for metric, values in aggregates.items():
+            totals = self.server_totals.setdefault(metric, dict())
+            for label_value, value in values.items():
+                total = totals.get(label_value, 0) + sign * value
+                if total:
+                    totals[label_value] = total
+                else:
+                    totals.pop(label_value, None)
+        for metric, count in dropped.items():
+            self.dropped_totals[metric] = self.dropped_totals.get(metric, 0) + sign * count
+
+    def set_player_contribution(self, uuid, contribution):
+        # server wide sums are kept up to date incrementally, only changed players are added again
+        previous = self.player_contributions.pop(uuid, None)
+        if previous is not None:
+            self.add_contribution(previous, -1)
+        if contribution is not None:
+            self.player_contributions[uuid] = contribution
+            self.add_contribution(contribution, 1)
+
+    def apply_cardinality_limits(self, uuid, samples):
+        samples, aggregates, dropped = limit_player_samples(samples, self.top_k, self.namespace_allow,
+                                                            self.namespace_deny, self.server_aggregates)
+        self.set_player_contribution(uuid, (aggregates, dropped))
+        return samples
+
+    def get_server_aggregates(self):
+        metrics = []
+        for metric in sorted(self.server_aggregates):
+            documentation, typ = self.player_metrics[metric]
+            label = CARDINALITY_LABELS[metric]
+            aggregate = Metric('server_' + metric, documentation + ", summed over all Players", typ)
+            for label_value, value in self.server_totals.get(metric, {}).items():
+                aggregate.add_sample('server_' + metric, value=value, labels={label: label_value})
+            metrics.append(aggregate)
+        for metric, count in self.dropped_totals.items():
+            SERIES_DROPPED.labels(self.server, metric).set(count)
+        return metrics
+
+    def player_tier(self, uuid, name, now):
+        if name in self.online_players:
+            self.player_last_active[uuid] = now
+            return 'online'
+        if now - self.player_last_active.get(uuid, 0) < self.active_player_window:
+            return 'active'
+        return 'dormant'
+
+    def get_dormant_player_samples(self, uuid, name, now):
+        if now < self.player_refresh_due.get(uuid, 0):
+            cached = self.player_cache.get(uuid)
+            if cached is not None and cached[0][-1] == name:
+                if uuid not in self.compacted_players:
+                    self.player_cache[uuid] = (cached[0], compact_samples(cached[1]))
+                    self.compacted_players.add(uuid)
+                return self.player_cache[uuid][1]
+        # jittered so dormant players do not all come due in the same collection
+        self.player_refresh_due[uuid] = now + self.dormant_refresh_interval * random.uniform(0.5, 1.5)
+        return None
+
+    def uuid_to_player(self, uuid):
+        # players are exported by uuid until their name has been resolved
+        return self.player_names.get(uuid) or uuid
+
     def get_server_stats(self):
-        if self.rcon is None or (not self.rcon_connected and not self.rcon_connect()):
+        if self.rcon is None or not self.rcon.available():
             return []
 
+        paper = self.paper_server
+        forge = self.forge_server
+        dynmap = self.dynmap_enabled
+        commands = ["list"]
+        if paper:
+            commands.append("tps")
+        if forge:
+            commands.extend(["forge tps", "forge entity list"])
+        if dynmap:
+            commands.append("dynmap stats")
+        responses = dict(zip(commands, self.rcon.run(*commands)))
+
         metrics = []
 
         dim_tps = Metric('dim_tps', 'TPS of a dimension', "counter")
@@ -100,33 +1490,35 @@ class MinecraftCollector(object):
 
         metrics.extend(
             [dim_tps, dim_ticktime, overall_tps, overall_ticktime, player_online, entities, tps_1m, tps_5m, tps_15m])
-        if 'PAPER_SERVER' in os.environ and os.environ['PAPER_SERVER'] == "True":
-            resp = str(self.rcon_command("tps")).strip().replace("§a", "")
+        if paper and responses["tps"]:
+            resp = responses["tps"].strip().replace("§a", "")
             tpsregex = re.compile("TPS from last 1m, 5m, 15m: (\d*\.\d*), (\d*\.\d*), (\d*\.\d*)")
             for m1, m5, m15 in tpsregex.findall(resp):
                 tps_1m.add_sample('paper_tps_1m', value=m1, labels={'tps': '1m'})
                 tps_5m.add_sample('paper_tps_5m', value=m5, labels={'tps': '5m'})
                 tps_15m.add_sample('paper_tps_15m', value=m15, labels={'tps': '15m'})
-        if 'FORGE_SERVER' in os.environ and os.environ['FORGE_SERVER'] == "True":
+        if forge and responses["forge tps"]:
             # dimensions
-            resp = self.rcon_command("forge tps")
+            resp = responses["forge tps"]
             dimtpsregex = re.compile("Dim (.*?)\s\((.*?)\):\sMean tick time:\s(.*?) ms\. Mean TPS: (\d*\.\d*)")
             for dimid, dimname, meanticktime, meantps in dimtpsregex.findall(resp):
                 dim_tps.add_sample('dim_tps', value=meantps, labels={'dimension_id': dimid, 'dimension_name': dimname})
                 dim_ticktime.add_sample('dim_ticktime', value=meanticktime,
                                         labels={'dimension_id': dimid, 'dimension_name': dimname})
             overallregex = re.compile("Overall\s?: Mean tick time: (.*) ms. Mean TPS: (.*)")
-            overall_tps.add_sample('overall_tps', value=overallregex.findall(resp)[0][1], labels={})
-            overall_ticktime.add_sample('overall_ticktime', value=overallregex.findall(resp)[0][0], labels={})
+            for meanticktime, meantps in overallregex.findall(resp)[:1]:
+                overall_tps.add_sample('overall_tps', value=meantps, labels={})
+                overall_ticktime.add_sample('overall_ticktime', value=meanticktime, labels={})
 
+        if forge and responses["forge entity list"]:
             # entites
-            resp = self.rcon_command("forge entity list")
+            resp = responses["forge entity list"]
             entityregex = re.compile("(\d+): (.*?:.*?)\s")
             for entitycount, entityname in entityregex.findall(resp):
                 entities.add_sample('entities', value=entitycount, labels={'entity': entityname})
 
         # dynmap
-        if 'DYNMAP_ENABLED' in os.environ and os.environ['DYNMAP_ENABLED'] == "True":
+        if dynmap:
             dynmap_tile_render_statistics = Metric('dynmap_tile_render_statistics',
                                                    'Tile Render Statistics reported by Dynmap', "counter")
             dynmap_chunk_loading_statistics_count = Metric('dynmap_chunk_loading_statistics_count',
@@ -136,7 +1528,7 @@ class MinecraftCollector(object):
             metrics.extend([dynmap_tile_render_statistics, dynmap_chunk_loading_statistics_count,
                             dynmap_chunk_loading_statistics_duration])
 
-            resp = self.rcon_command("dynmap stats")
+            resp = responses["dynmap stats"] or ""
 
             dynmaptilerenderregex = re.compile("  (.*?): processed=(\d*), rendered=(\d*), updated=(\d*)")
             for dim, processed, rendered, updated in dynmaptilerenderregex.findall(resp):
@@ -155,219 +1547,349 @@ class MinecraftCollector(object):
                                                                     value=duration_per_chunk, labels={'type': state})
 
         # player
-        resp = self.rcon_command("list")
+        resp = responses["list"] or ""
         playerregex = re.compile("players online:(.*)")
         if playerregex.findall(resp):
+            online_players = set()
             for player in playerregex.findall(resp)[0].split(","):
                 if not player.isspace():
                     player_online.add_sample('player_online', value=1, labels={'player': player.lstrip()})
+                    online_players.add(player.strip())
+            self.online_players = online_players
 
         return metrics
 
+    def update_quest_index(self):
+        progress_file = self.better_questing + "/QuestProgress.json"
+        database_file = self.better_questing + "/QuestDatabase.json"
+        fingerprint = (file_fingerprint(progress_file), file_fingerprint(database_file))
+        if fingerprint == self.quest_fingerprint:
+            CACHE_REQUESTS.labels('quests', 'hit').inc()
+            return
+        CACHE_REQUESTS.labels('quests', 'miss').inc()
+        try:
+            with FILE_PARSE_DURATION.labels('quests').time():
+                self.quests_finished, self.quests_finished_by_chapter, self.quest_completions = read_quest_index(
+                    progress_file, database_file)
+        except Exception as e:
+            print("Failed to read BetterQuesting progress:", e)
+            ERRORS.labels('quests').inc()
+            return
+        FILE_READ_BYTES.labels('quests').inc(sum(f[1] for f in fingerprint if f is not None))
+        self.quest_fingerprint = fingerprint
+
     def get_player_quests_finished(self, uuid):
-        with open(self.better_questing + "/QuestProgress.json") as json_file:
-            data = json.load(json_file)
-            json_file.close()
-        counter = 0
-        for _, value in data['questProgress:9'].items():
-            for _, u in value['tasks:9']['0:10']['completeUsers:9'].items():
-                if u == uuid:
-                    counter += 1
-        return counter
+        return self.quests_finished.get(uuid, 0)
+
+    def add_player_quests(self, uuid, data):
+        data["stat.questsFinished"] = self.get_player_quests_finished(uuid)
+        data["stat.questsFinishedByChapter"] = self.quests_finished_by_chapter.get(uuid, {})
+
+    def get_quest_stats(self):
+        quest_completions = Metric('quest_completions', 'Number of Players that have finished a quest', "counter")
+        for quest, value in self.quest_completions.items():
+            quest_completions.add_sample('quest_completions', value=value, labels={'quest': quest})
+        return [quest_completions]
 
     def get_player_stats(self, uuid):
-        with open(self.stats_directory + "/" + uuid + ".json") as json_file:
-            data = json.load(json_file)
-            json_file.close()
-        nbtfile = nbt.nbt.NBTFile(self.player_directory + "/" + uuid + ".dat", 'rb')
-        data["stat.XpTotal"] = nbtfile.get("XpTotal").value
-        data["stat.XpLevel"] = nbtfile.get("XpLevel").value
-        data["stat.Score"] = nbtfile.get("Score").value
-        data["stat.Health"] = nbtfile.get("Health").value
-        data["stat.foodLevel"] = nbtfile.get("foodLevel").value
-        with open(self.advancements_directory + "/" + uuid + ".json") as json_file:
-            count = 0
-            advancements = json.load(json_file)
-            for key, value in advancements.items():
-                if key in ("DataVersion"):
-                    continue
-                if value["done"] == True:
-                    count += 1
-        data["stat.advancements"] = count
+        data = read_player_files(*self.player_files(uuid), self.playerdata_tags, self.inventory_items)
         if self.quests_enabled:
-            data["stat.questsFinished"] = self.get_player_quests_finished(uuid)
+            self.add_player_quests(uuid, data)
         return data
 
-    def update_metrics_for_player(self, uuid):
-        name = self.uuid_to_player(uuid)
-        if not name:
-            return
+    def parse_players(self, uuids):
+        files = [self.player_files(uuid) for uuid in uuids]
+        parse = partial(parse_player_files, playerdata_tags=self.playerdata_tags, inventory_items=self.inventory_items)
+        if self.parse_pool is None:
+            results = [parse(*f) for f in files]
+        elif files:
+            chunksize = max(1, len(files) // (self.parse_workers * 4))
+            results = list(self.parse_pool.map(parse, *zip(*files), chunksize=chunksize))
+        else:
+            results = []
+        parsed = []
+        for uuid, (data, timings) in zip(uuids, results):
+            for file, (seconds, size) in timings.items():
+                FILE_PARSE_DURATION.labels(file).observe(seconds)
+                FILE_READ_BYTES.labels(file).inc(size)
+            if data is None:
+                ERRORS.labels('parse').inc()
+            elif self.quests_enabled:
+                self.add_player_quests(uuid, data)
+            parsed.append(data)
+        return parsed
 
-        data = self.get_player_stats(uuid)
-
-        blocks_mined = Metric('blocks_mined', 'Blocks a Player mined', "counter")
-        blocks_picked_up = Metric('blocks_picked_up', 'Blocks a Player picked up', "counter")
-        player_deaths = Metric('player_deaths', 'How often a Player died', "counter")
-        player_jumps = Metric('player_jumps', 'How often a Player has jumped', "counter")
-        cm_traveled = Metric('cm_traveled', 'How many cm a Player traveled, whatever that means', "counter")
-        player_xp_total = Metric('player_xp_total', "How much total XP a player has", "counter")
-        player_current_level = Metric('player_current_level', "How much current XP a player has", "counter")
-        player_food_level = Metric('player_food_level', "How much food the player currently has", "counter")
-        player_health = Metric('player_health', "How much Health the player currently has", "counter")
-        player_score = Metric('player_score', "The Score of the player", "counter")
-        entities_killed = Metric('entities_killed', "Entities killed by player", "counter")
-        damage_taken = Metric('damage_taken', "Damage Taken by Player", "counter")
-        damage_dealt = Metric('damage_dealt', "Damage dealt by Player", "counter")
-        blocks_crafted = Metric('blocks_crafted', "Items a Player crafted", "counter")
-        player_playtime = Metric('player_playtime', "Time in Minutes a Player was online", "counter")
-        player_advancements = Metric('player_advancements', "Number of completed advances of a player", "counter")
-        player_slept = Metric('player_slept', "Times a Player slept in a bed", "counter")
-        player_quests_finished = Metric('player_quests_finished', 'Number of quests a Player has finished', 'counter')
-        player_used_crafting_table = Metric('player_used_crafting_table', "Times a Player used a Crafting Table",
-                                            "counter")
-        mc_custom = Metric('mc_custom', "Custom Minecraft stat", "counter")
-        for key, value in data.items():  # pre 1.15
-            if key in ("stats", "DataVersion"):
-                continue
-            stat = key.split(".")[1]  # entityKilledBy
-            if stat == "mineBlock":
-                blocks_mined.add_sample("blocks_mined", value=value, labels={'player': name, 'block': '.'.join(
-                    (key.split(".")[2], key.split(".")[3]))})
-            elif stat == "pickup":
-                blocks_picked_up.add_sample("blocks_picked_up", value=value, labels={'player': name, 'block': '.'.join(
-                    (key.split(".")[2], key.split(".")[3]))})
-            elif stat == "entityKilledBy":
-                if len(key.split(".")) == 4:
-                    player_deaths.add_sample('player_deaths', value=value, labels={'player': name, 'cause': '.'.join(
-                        (key.split(".")[2], key.split(".")[3]))})
-                else:
-                    player_deaths.add_sample('player_deaths', value=value,
-                                             labels={'player': name, 'cause': key.split(".")[2]})
-            elif stat == "jump":
-                player_jumps.add_sample("player_jumps", value=value, labels={'player': name})
-            elif stat == "walkOneCm":
-                cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "walking"})
-            elif stat == "swimOneCm":
-                cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "swimming"})
-            elif stat == "sprintOneCm":
-                cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "sprinting"})
-            elif stat == "diveOneCm":
-                cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "diving"})
-            elif stat == "fallOneCm":
-                cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "falling"})
-            elif stat == "flyOneCm":
-                cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "flying"})
-            elif stat == "boatOneCm":
-                cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "boat"})
-            elif stat == "horseOneCm":
-                cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "horse"})
-            elif stat == "climbOneCm":
-                cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "climbing"})
-            elif stat == "XpTotal":
-                player_xp_total.add_sample('player_xp_total', value=value, labels={'player': name})
-            elif stat == "XpLevel":
-                player_current_level.add_sample('player_current_level', value=value, labels={'player': name})
-            elif stat == "foodLevel":
-                player_food_level.add_sample('player_food_level', value=value, labels={'player': name})
-            elif stat == "Health":
-                player_health.add_sample('player_health', value=value, labels={'player': name})
-            elif stat == "Score":
-                player_score.add_sample('player_score', value=value, labels={'player': name})
-            elif stat == "killEntity":
-                entities_killed.add_sample('entities_killed', value=value,
-                                           labels={'player': name, "entity": key.split(".")[2]})
-            elif stat == "damageDealt":
-                damage_dealt.add_sample('damage_dealt', value=value, labels={'player': name})
-            elif stat == "damageTaken":
-                damage_dealt.add_sample('damage_taken', value=value, labels={'player': name})
-            elif stat == "craftItem":
-                blocks_crafted.add_sample('blocks_crafted', value=value, labels={'player': name, 'block': '.'.join(
-                    (key.split(".")[2], key.split(".")[3]))})
-            elif stat == "playOneMinute":
-                player_playtime.add_sample('player_playtime', value=value, labels={'player': name})
-            elif stat == "advancements":
-                player_advancements.add_sample('player_advancements', value=value, labels={'player': name})
-            elif stat == "sleepInBed":
-                player_slept.add_sample('player_slept', value=value, labels={'player': name})
-            elif stat == "craftingTableInteraction":
-                player_used_crafting_table.add_sample('player_used_crafting_table', value=value,
-                                                      labels={'player': name})
-            elif stat == "questsFinished":
-                player_quests_finished.add_sample('player_quests_finished', value=value, labels={'player': name})
-
-        if "stats" in data:  # Minecraft > 1.15
-            if "minecraft:crafted" in data["stats"]:
-                for block, value in data["stats"]["minecraft:crafted"].items():
-                    blocks_crafted.add_sample('blocks_crafted', value=value, labels={'player': name, 'block': block})
-            if "minecraft:mined" in data["stats"]:
-                for block, value in data["stats"]["minecraft:mined"].items():
-                    blocks_mined.add_sample("blocks_mined", value=value, labels={'player': name, 'block': block})
-            if "minecraft:picked_up" in data["stats"]:
-                for block, value in data["stats"]["minecraft:picked_up"].items():
-                    blocks_picked_up.add_sample("blocks_picked_up", value=value,
-                                                labels={'player': name, 'block': block})
-            if "minecraft:killed" in data["stats"]:
-                for entity, value in data["stats"]["minecraft:killed"].items():
-                    entities_killed.add_sample('entities_killed', value=value,
-                                               labels={'player': name, "entity": entity})
-            if "minecraft:killed_by" in data["stats"]:
-                for entity, value in data["stats"]["minecraft:killed_by"].items():
-                    player_deaths.add_sample('player_deaths', value=value, labels={'player': name, 'cause': entity})
-            for stat, value in data["stats"]["minecraft:custom"].items():
-                if stat == "minecraft:jump":
-                    player_jumps.add_sample("player_jumps", value=value, labels={'player': name})
-                elif stat == "minecraft:deaths":
-                    player_deaths.add_sample('player_deaths', value=value, labels={'player': name})
-                elif stat == "minecraft:damage_taken":
-                    damage_taken.add_sample('damage_taken', value=value, labels={'player': name})
-                elif stat == "minecraft:damage_dealt":
-                    damage_dealt.add_sample('damage_dealt',value=value,labels={'player':name})
-                elif stat == "minecraft:play_time":
-                    player_playtime.add_sample('player_playtime',value=value,labels={'player':name})
-                elif stat == "minecraft:play_one_minute": # pre 1.17
-                    player_playtime.add_sample('player_playtime',value=value,labels={'player':name})
-                elif stat == "minecraft:walk_one_cm":
-                    cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "walking"})
-                elif stat == "minecraft:walk_on_water_one_cm":
-                    cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "swimming"})
-                elif stat == "minecraft:sprint_one_cm":
-                    cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "sprinting"})
-                elif stat == "minecraft:walk_under_water_one_cm":
-                    cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "diving"})
-                elif stat == "minecraft:fall_one_cm":
-                    cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "falling"})
-                elif stat == "minecraft:fly_one_cm":
-                    cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "flying"})
-                elif stat == "minecraft:boat_one_cm":
-                    cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "boat"})
-                elif stat == "minecraft:horse_one_cm":
-                    cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "horse"})
-                elif stat == "minecraft:climb_one_cm":
-                    cm_traveled.add_sample("cm_traveled", value=value, labels={'player': name, 'method': "climbing"})
-                elif stat == "minecraft:sleep_in_bed":
-                    player_slept.add_sample('player_slept', value=value, labels={'player': name})
-                elif stat == "minecraft:interact_with_crafting_table":
-                    player_used_crafting_table.add_sample('player_used_crafting_table', value=value,
-                                                          labels={'player': name})
+    def request_profile(self, *args):
+        # usable as signal handler, the next collection is profiled
+        self.profile_requested = True
+
+    def profile(self, collect):
+        # tracemalloc is process wide, servers collecting on their own threads are profiled one after another
+        with PROFILE_LOCK:
+            profiler = cProfile.Profile()
+            tracemalloc.start(25)
+            profiler.enable()
+            try:
+                metrics = collect()
+            finally:
+                profiler.disable()
+                allocations = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+        prefix = "collection-" + (self.server + "-" if self.server else "")
+        path = join(self.profile_directory, prefix + time.strftime("%Y%m%d-%H%M%S"))
+        # the collection itself succeeded, a report that cannot be written must not lose it
+        try:
+            os.makedirs(self.profile_directory, exist_ok=True)
+            profiler.dump_stats(path + ".prof")
+            with open(path + ".txt", "w") as report:
+                pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(50)
+                report.write(f"tracemalloc: {current} bytes allocated, {peak} bytes peak\n\n")
+                for stat in allocations.statistics("lineno")[:50]:
+                    report.write(f"{stat}\n")
+            print("Wrote collection profile to", path + ".txt")
+        except Exception as e:
+            print("Failed to write collection profile:", repr(e))
+            ERRORS.labels('profile').inc()
+        return metrics
+
+    def collect_samples(self):
+        # returns (uuid -> metric -> samples, metrics not belonging to a player)
+        # uuid -> samples, in get_players() order so the output is deterministic
+        player_samples = dict()
+        stale = []
+        if self.quests_enabled:
+            with PHASE_DURATION.labels(self.server, 'quests').time():
+                self.update_quest_index()
+
+        with PHASE_DURATION.labels(self.server, 'players').time():
+            players = self.get_players()
+            self.evict_missing_players(players)
+
+        with PHASE_DURATION.labels(self.server, 'names').time():
+            names = [self.uuid_to_player(uuid) for uuid in players]
+
+        # the online players from RCON decide which players are refreshed
+        with PHASE_DURATION.labels(self.server, 'server').time():
+            server_metrics = self.get_server_stats()
+
+        with PHASE_DURATION.labels(self.server, 'fingerprints').time():
+            now = time.time()
+            tiers = {'online': 0, 'active': 0, 'dormant': 0}
+            for uuid, name in zip(players, names):
+                tier = self.player_tier(uuid, name, now)
+                tiers[tier] += 1
+                if tier == 'dormant' and self.dormant_refresh_interval:
+                    player_samples[uuid] = self.get_dormant_player_samples(uuid, name, now)
+                    if player_samples[uuid] is not None:
+                        continue
+                fingerprint = self.player_fingerprint(uuid) + (name,)
+                stats_mtime = fingerprint[0][0] if fingerprint[0] is not None else 0
+                if now - stats_mtime / 1e9 < self.active_player_window:
+                    self.player_last_active[uuid] = max(self.player_last_active.get(uuid, 0), stats_mtime / 1e9)
+                player_samples[uuid] = self.get_cached_player_samples(uuid, fingerprint)
+                if player_samples[uuid] is None:
+                    stale.append((uuid, name, fingerprint))
+            CACHE_REQUESTS.labels('player', 'hit').inc(len(players) - len(stale))
+            CACHE_REQUESTS.labels('player', 'miss').inc(len(stale))
+            for tier, count in tiers.items():
+                PLAYER_TIERS.labels(self.server, tier).set(count)
+
+        with PHASE_DURATION.labels(self.server, 'parse').time():
+            parsed = self.parse_players([uuid for uuid, _, _ in stale])
+
+        with PHASE_DURATION.labels(self.server, 'build').time():
+            for (uuid, name, fingerprint), data in zip(stale, parsed):
+                if data is None:
+                    # remembered like any other player, broken files are only parsed again once they change
+                    player_samples[uuid] = dict()
+                    self.set_player_contribution(uuid, None)
                 else:
-                    mc_custom.add_sample('mc_custom', value=value, labels={'stat': stat})
-        return [blocks_mined, blocks_picked_up, player_deaths, player_jumps, cm_traveled, player_xp_total,
-                player_current_level, player_food_level, player_health, player_score, entities_killed, damage_taken,
-                damage_dealt, blocks_crafted, player_playtime, player_advancements, player_slept,
-                player_used_crafting_table, player_quests_finished, mc_custom]
+                    player_samples[uuid] = build_player_samples(self.stat_mappings, name, data, self.server)
+                    if self.cardinality_limited:
+                        player_samples[uuid] = self.apply_cardinality_limits(uuid, player_samples[uuid])
+                self.cache_player_samples(uuid, fingerprint, player_samples[uuid])
+
+        metrics = []
+        if self.cardinality_limited:
+            metrics.extend(self.get_server_aggregates())
+        if self.quests_enabled:
+            metrics.extend(self.get_quest_stats())
+        metrics.extend(server_metrics)
+        if self.world_scanner is not None:
+            metrics.extend(self.world_scanner.get_metrics())
+        if self.server:
+            add_server_label(metrics, self.server)
+        return player_samples, metrics
+
+    def collect_metrics(self):
+        if self.profile_requested and self.profile_directory:
+            self.profile_requested = False
+            return self.profile(self.collect_metrics)
+
+        player_samples, server_metrics = self.collect_samples()
+        with PHASE_DURATION.labels(self.server, 'families').time():
+            # one family per metric, shared by all players
+            families = {metric: Metric(metric, documentation, typ)
+                        for metric, (documentation, typ) in self.player_metrics.items()}
+            for samples in player_samples.values():
+                for metric, metric_samples in samples.items():
+                    families[metric].samples.extend(metric_samples)
+
+        metrics = list(families.values()) + server_metrics
+        SERIES.labels(self.server).set(sum(len(metric.samples) for metric in metrics))
+        return metrics
+
+    def render_players(self, player_samples):
+        # returns metric -> rendered samples of all players, players are only rendered again when their samples
+        # changed and families only joined again when any player did
+        fragments = []
+        for uuid, samples in player_samples.items():
+            cached = self.player_fragments.get(uuid)
+            if cached is None or cached[0] is not samples:
+                cached = (samples, {metric: render_samples(s) for metric, s in samples.items()})
+                self.player_fragments[uuid] = cached
+            fragments.append(cached[1])
+        previous, families = self.player_body
+        if len(previous) == len(fragments) and all(a is b for a, b in zip(previous, fragments)):
+            return families
+        families = {metric: b"".join(f[metric] for f in fragments if metric in f) for metric in self.family_headers}
+        self.player_body = (fragments, families)
+        return families
+
+    def render_parts(self):
+        # returns (metric -> rendered player samples, other metrics) for assemble_exposition
+        if self.profile_requested and self.profile_directory:
+            self.profile_requested = False
+            return self.profile(self.render_parts)
+
+        player_samples, metrics = self.collect_samples()
+        SERIES.labels(self.server).set(sum(len(s) for samples in player_samples.values() for s in samples.values()) +
+                                       sum(len(metric.samples) for metric in metrics))
+        with PHASE_DURATION.labels(self.server, 'render').time():
+            return self.render_players(player_samples), metrics
+
+    def refresh_snapshot(self):
+        with self.collect_lock:
+            if self.prerender:
+                timestamp = time.time()
+                families, metrics = self.render_parts()
+                snapshot_timestamp = Metric('minecraft_exporter_snapshot_timestamp_seconds',
+                                            'Time the served metric snapshot was collected at', "gauge")
+                snapshot_timestamp.add_sample('minecraft_exporter_snapshot_timestamp_seconds', value=timestamp,
+                                              labels=self.server_labels)
+                self.snapshot = (timestamp, (families, metrics + [snapshot_timestamp]))
+                return
+            metrics = tuple(self.collect_metrics())
+        self.snapshot = (time.time(), metrics)
+
+    def run_snapshot_refresher(self):
+        while True:
+            started = time.time()
+            try:
+                self.refresh_snapshot()
+            except Exception as e:
+                print("Snapshot refresh failed:", e)
+                ERRORS.labels('snapshot').inc()
+            time.sleep(max(0.0, self.snapshot_interval - (time.time() - started)))
+
+    def start_world_scanner(self):
+        if self.world_scanner is not None:
+            self.world_scanner.start()
+
+    def start_snapshot_refresher(self):
+        print(f"Refreshing metric snapshot{' of ' + self.server if self.server else ''} "
+              f"every {self.snapshot_interval} seconds")
+        threading.Thread(target=self.run_snapshot_refresher, name=f"snapshot-refresher-{self.server}",
+                         daemon=True).start()
 
     def collect(self):
-        for player in self.get_players():
-            metrics = self.update_metrics_for_player(player)
-            if not metrics:
-                continue
+        if not self.snapshot_interval:
+            with self.collect_lock:
+                return self.collect_metrics()
+
+        snapshot = self.snapshot
+        if snapshot is None:
+            return []
+        timestamp, metrics = snapshot
+        snapshot_age = Metric('minecraft_exporter_snapshot_age_seconds',
+                              'Seconds since the served metric snapshot was collected', "gauge")
+        snapshot_age.add_sample('minecraft_exporter_snapshot_age_seconds', value=time.time() - timestamp,
+                                labels=self.server_labels)
+        return metrics + (snapshot_age,)
+
+    def exposition(self):
+        if not self.snapshot_interval:
+            with self.collect_lock:
+                # every collection changes the self instrumentation, only the players are reused
+                exposition = assemble_exposition(self.family_headers, [self.render_parts()], self.exposition_cache[1])
+                self.exposition_cache = (None, exposition)
+                return exposition
 
-            for metric in metrics:
-                yield metric
+        snapshot = self.snapshot
+        if snapshot is None:
+            return Exposition((Fragment(generate_latest(REGISTRY)),))
+        # the body of a snapshot is only assembled and compressed once
+        cached_snapshot, exposition = self.exposition_cache
+        if cached_snapshot is not snapshot:
+            exposition = assemble_exposition(self.family_headers, [snapshot[1]], exposition)
+            self.exposition_cache = (snapshot, exposition)
+        return exposition
 
-        for metric in self.get_server_stats():
-            yield metric
 
+class MultiServerCollector(object):
+    # one MinecraftCollector per server of SERVERS_CONFIG, sharing the name cache and parse workers,
+    # each collecting on its own thread so a slow or offline server does not hold up the others
+    def __init__(self, config_file):
+        with open(config_file) as json_file:
+            servers = json.load(json_file)
+        self.player_names = create_name_resolver(os.environ, None)
+        self.parse_pool = create_parse_pool(os.environ)
+        self.snapshot_interval = float(os.environ.get('SNAPSHOT_INTERVAL', 0)) or 30.0
+        self.profile_directory = os.environ.get('PROFILE_DIR')
+        self.prerender = 'PRERENDER' in os.environ and os.environ['PRERENDER'] == "True"
+
+        self.collectors = []
+        for server in servers:
+            collector = MinecraftCollector({'SNAPSHOT_INTERVAL': self.snapshot_interval, **server},
+                                           self.player_names, self.parse_pool)
+            self.collectors.append(collector)
+            usercache_file = server.get('USERCACHE_FILE')
+            if usercache_file:
+                self.player_names.load_usercache(usercache_file)
+                schedule.every().day.at("01:00").do(self.player_names.load_usercache, usercache_file)
+        print(f"Monitoring {len(self.collectors)} servers from {config_file}")
+
+        self.family_headers = dict()
+        for collector in self.collectors:
+            for metric, header in collector.family_headers.items():
+                self.family_headers.setdefault(metric, header)
+        self.exposition_cache = ((), None)
+
+    def start_world_scanner(self):
+        for collector in self.collectors:
+            collector.start_world_scanner()
+
+    def start_snapshot_refresher(self):
+        for collector in self.collectors:
+            collector.start_snapshot_refresher()
+
+    def request_profile(self, *args):
+        for collector in self.collectors:
+            collector.request_profile()
+
+    def collect(self):
+        return merge_metrics(metric for collector in self.collectors for metric in collector.collect())
+
+    def exposition(self):
+        snapshots = tuple(collector.snapshot for collector in self.collectors)
+        cached_snapshots, exposition = self.exposition_cache
+        if exposition is None or any(a is not b for a, b in zip(cached_snapshots, snapshots)):
+            exposition = assemble_exposition(self.family_headers,
+                                             [snapshot[1] for snapshot in snapshots if snapshot is not None],
+                                             exposition)
+            self.exposition_cache = (snapshots, exposition)
+        return exposition
 
 if __name__ == '__main__':
     try:
@@ -375,8 +1897,22 @@ if __name__ == '__main__':
     except:
         HTTP_PORT = 8000
 
-    start_http_server(HTTP_PORT)
-    REGISTRY.register(MinecraftCollector())
+    if 'SERVERS_CONFIG' in os.environ:
+        collector = MultiServerCollector(os.environ['SERVERS_CONFIG'])
+    else:
+        collector = MinecraftCollector()
+    if collector.snapshot_interval:
+        collector.start_snapshot_refresher()
+    collector.start_world_scanner()
+    if collector.profile_directory:
+        signal.signal(signal.SIGUSR1, collector.request_profile)
+        print(f"Send SIGUSR1 to write a profile of the next collection to {collector.profile_directory}")
+
+    if collector.prerender:
+        start_exposition_server(HTTP_PORT, collector)
+    else:
+        start_http_server(HTTP_PORT)
+        REGISTRY.register(collector)
 
     print(f'Exporter started on Port {HTTP_PORT}')
 
@@ -0,0 +1,79 @@
+import gzip
+import os
+import time
+import urllib.request
+
+import pytest
+from prometheus_client import generate_latest
+
+from benchmark import generate_world
+from minecraft_exporter import MinecraftCollector, StaticCollector, start_exposition_server
+
+
+@pytest.fixture
+def world(tmp_path, monkeypatch):
+    uuids = generate_world(str(tmp_path), 20, blocks=30, inventory=5)
+    monkeypatch.setenv('WORLD_DIR', str(tmp_path / "world"))
+    monkeypatch.setenv('USERCACHE_FILE', str(tmp_path / "usercache.json"))
+    monkeypatch.setenv('NAME_CACHE_FILE', "")
+    monkeypatch.setenv('PRERENDER', "True")
+    return tmp_path, uuids
+
+
+def body(exposition):
+    return b"".join(exposition.chunks(False))
+
+
+def test_matches_prometheus_client(world):
+    collector = MinecraftCollector()
+    expected = generate_latest(StaticCollector(collector.collect_metrics()))
+    assert body(collector.exposition()).startswith(expected)
+
+
+def test_unchanged_players_are_rendered_and_compressed_once(world):
+    collector = MinecraftCollector()
+    first = collector.exposition()
+    first.chunks(True)
+    second = collector.exposition()
+    assert second.fragments[0] is first.fragments[0]
+    assert second.fragments[0].compressed is not None
+    # concatenated gzip members decompress to the whole body
+    assert gzip.decompress(b"".join(second.chunks(True))) == body(second)
+
+
+def test_changed_player_is_rendered_again(world):
+    tmp_path, uuids = world
+    collector = MinecraftCollector()
+    first = collector.exposition()
+    stats = tmp_path / "world" / "stats" / (uuids[0] + ".json")
+    os.utime(stats, (time.time() + 10, time.time() + 10))
+    second = collector.exposition()
+    assert second.fragments[0] is not first.fragments[0]
+    assert body(second).startswith(generate_latest(StaticCollector(collector.collect_metrics())))
+
+
+def test_snapshots_keep_their_etag(world, monkeypatch):
+    monkeypatch.setenv('SNAPSHOT_INTERVAL', "60")
+    collector = MinecraftCollector()
+    collector.refresh_snapshot()
+    server = start_exposition_server(0, collector)
+    url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers={'Accept-Encoding': "gzip"})) as response:
+            assert response.headers['Content-Encoding'] == "gzip"
+            etag = response.headers['ETag']
+            text = gzip.decompress(response.read())
+        assert text == body(collector.exposition())
+        assert b"minecraft_exporter_snapshot_timestamp_seconds" in text
+
+        request = urllib.request.Request(url, headers={'If-None-Match': etag})
+        with pytest.raises(urllib.error.HTTPError) as not_modified:
+            urllib.request.urlopen(request)
+        assert not_modified.value.code == 304
+
+        collector.refresh_snapshot()
+        with urllib.request.urlopen(request) as response:
+            assert response.headers['ETag'] != etag
+            assert response.read() == body(collector.exposition())
+    finally:
+        server.shutdown()
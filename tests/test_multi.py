@@ -0,0 +1,56 @@
+import json
+import os
+import threading
+
+import pytest
+from prometheus_client import generate_latest
+
+from benchmark import generate_world
+from minecraft_exporter import MultiServerCollector, StaticCollector
+
+
+@pytest.fixture
+def servers(tmp_path, monkeypatch):
+    config = []
+    for name, players in (("a", 5), ("b", 7)):
+        generate_world(str(tmp_path / name), players, blocks=10, inventory=2)
+        config.append({"name": name, "WORLD_DIR": str(tmp_path / name / "world"),
+                       "USERCACHE_FILE": str(tmp_path / name / "usercache.json")})
+    (tmp_path / "servers.json").write_text(json.dumps(config))
+    monkeypatch.setenv('NAME_CACHE_FILE', "")
+    monkeypatch.setenv('PROFILE_DIR', str(tmp_path))
+    return str(tmp_path / "servers.json")
+
+
+def test_series_are_merged_and_labelled(servers):
+    collector = MultiServerCollector(servers)
+    for server in collector.collectors:
+        server.refresh_snapshot()
+    text = generate_latest(StaticCollector(collector.collect())).decode()
+    types = [line for line in text.splitlines() if line.startswith("# TYPE")]
+    assert len(types) == len(set(types))
+    blocks_mined = [line for line in text.splitlines() if line.startswith("blocks_mined{")]
+    assert {'server="a"' in line for line in blocks_mined} == {True, False}
+    assert all('server="a"' in line or 'server="b"' in line for line in blocks_mined)
+
+
+def test_profiles_every_server(servers, tmp_path):
+    collector = MultiServerCollector(servers)
+    collector.request_profile()
+    errors = []
+
+    def refresh(server):
+        try:
+            server.refresh_snapshot()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=refresh, args=(server,)) for server in collector.collectors]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert all(server.snapshot is not None for server in collector.collectors)
+    reports = [name for name in os.listdir(tmp_path) if name.endswith(".txt")]
+    assert sorted(name.split("-")[1] for name in reports) == ["a", "b"]
@@ -0,0 +1,184 @@
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from minecraft_exporter import PlayerNameResolver
+
+UUID = "069a79f4-44e9-4726-a5be-fca90e38aaf5"
+
+
+class SessionServer(ThreadingHTTPServer):
+    # stand-in for the Mojang session server answering each uuid from a list of (status, body)
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SessionHandler)
+        self.responses = dict()
+        self.requests = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/profile/"
+
+
+class SessionHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        uuid = self.path.rsplit("/", 1)[1]
+        self.server.requests.append((uuid, time.monotonic()))
+        responses = self.server.responses.get(uuid, [(404, None)])
+        status, body = responses.pop(0) if len(responses) > 1 else responses[0]
+        payload = body.encode() if isinstance(body, str) else json.dumps(body).encode() if body else b""
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = SessionServer()
+    yield server
+    server.shutdown()
+
+
+def resolver(server, cache_file="", ttl=3600):
+    names = PlayerNameResolver(cache_file, None, ttl, 100, server.url)
+    names.rate_limit_backoff = 0.5
+    return names
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+def resolved(names, uuid=UUID):
+    return lambda: uuid in names.names and uuid not in names.pending
+
+
+def test_resolves_in_background(server):
+    server.responses[UUID.replace("-", "")] = [(200, {"id": UUID.replace("-", ""), "name": "jeb_"})]
+    names = resolver(server)
+    assert names.get(UUID) is None
+    wait_for(resolved(names))
+    assert names.get(UUID) == "jeb_"
+    assert len(server.requests) == 1
+
+
+@pytest.mark.parametrize("status", [204, 404])
+def test_unknown_uuids_are_cached(server, status):
+    server.responses[UUID.replace("-", "")] = [(status, None)]
+    names = resolver(server)
+    names.get(UUID)
+    wait_for(resolved(names))
+    assert names.names[UUID][0] is None
+    assert names.get(UUID) is None
+    time.sleep(0.1)
+    assert len(server.requests) == 1
+
+
+def test_rate_limit_backs_off(server):
+    other = "853c80ef-3c37-49fd-aa49-938b674adae6"
+    server.responses[UUID.replace("-", "")] = [(429, None), (200, {"name": "jeb_"})]
+    server.responses[other.replace("-", "")] = [(200, {"name": "Notch"})]
+    names = resolver(server)
+    names.get(UUID)
+    names.get(other)
+    wait_for(resolved(names, other))
+    assert UUID not in names.names
+    (_, limited), (_, next_lookup) = server.requests
+    assert next_lookup - limited >= names.rate_limit_backoff
+    names.get(UUID)
+    wait_for(resolved(names))
+    assert names.get(UUID) == "jeb_"
+
+
+def test_expired_names_are_served_while_refreshing(server):
+    server.responses[UUID.replace("-", "")] = [(200, {"name": "old"}), (200, {"name": "new"})]
+    names = resolver(server, ttl=0.2)
+    names.get(UUID)
+    wait_for(resolved(names))
+    time.sleep(0.3)
+    assert names.get(UUID) == "old"
+    wait_for(lambda: names.names[UUID][0] == "new")
+    assert len(server.requests) == 2
+
+
+def test_worker_survives_bad_responses(server):
+    other = "853c80ef-3c37-49fd-aa49-938b674adae6"
+    server.responses[UUID.replace("-", "")] = [(200, "not json")]
+    server.responses[other.replace("-", "")] = [(200, {"name": "Notch"})]
+    names = resolver(server)
+    names.get(UUID)
+    wait_for(lambda: UUID.replace("-", "") in [uuid for uuid, _ in server.requests] and UUID not in names.pending)
+    names.get(other)
+    wait_for(resolved(names, other))
+    assert names.get(other) == "Notch"
+
+
+def test_cache_round_trip(server, tmp_path):
+    cache_file = str(tmp_path / "playernames.json")
+    server.responses[UUID.replace("-", "")] = [(200, {"name": "jeb_"})]
+    names = resolver(server, cache_file)
+    names.get(UUID)
+    wait_for(resolved(names))
+    wait_for(lambda: (tmp_path / "playernames.json").exists())
+
+    restarted = resolver(server, cache_file)
+    assert restarted.names[UUID] == names.names[UUID]
+    assert restarted.get(UUID) == "jeb_"
+    assert len(server.requests) == 1
+
+
+def test_usercache_is_loaded_while_saving(server, tmp_path):
+    usercache = tmp_path / "usercache.json"
+    usercache.write_text(json.dumps([{"uuid": f"00000000-0000-0000-0000-{i:012d}", "name": f"p{i}"}
+                                     for i in range(20000)]))
+    names = resolver(server, str(tmp_path / "playernames.json"))
+    loaded = threading.Event()
+    errors = []
+
+    def save():
+        # the worker saving the cache while the daily schedule reloads the usercache
+        while not loaded.is_set():
+            try:
+                names.save_cache()
+            except Exception as e:
+                errors.append(e)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    saver = threading.Thread(target=save)
+    saver.start()
+    try:
+        for _ in range(30):
+            with names.lock:
+                names.names.clear()
+            names.load_usercache(str(usercache))
+    finally:
+        loaded.set()
+        saver.join()
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+    assert names.get("00000000-0000-0000-0000-000000000007") == "p7"
+
+
+def test_usercache_reload_extends_expiry(server, tmp_path):
+    usercache = tmp_path / "usercache.json"
+    usercache.write_text(json.dumps([{"uuid": UUID, "name": "jeb_"}]))
+    names = resolver(server, ttl=0.5)
+    names.load_usercache(str(usercache))
+    time.sleep(0.6)
+    names.load_usercache(str(usercache))
+    assert names.get(UUID) == "jeb_"
+    assert UUID not in names.pending
+    assert server.requests == []
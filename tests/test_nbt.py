@@ -0,0 +1,181 @@
+import io
+import json
+import zlib
+
+import pytest
+from nbt import nbt
+
+from minecraft_exporter import nbt_paths, read_nbt, read_nbt_bytes, read_nbt_file, read_player_files
+
+
+def to_python(tag):
+    # the value the nbt library decoded, in the shape read_nbt returns
+    if isinstance(tag, (nbt.TAG_Compound, nbt.NBTFile)):
+        return {child.name: to_python(child) for child in tag.tags}
+    if isinstance(tag, nbt.TAG_List):
+        return [to_python(child) for child in tag.tags]
+    if isinstance(tag, nbt.TAG_Byte_Array):
+        return [b - 256 if b > 127 else b for b in tag.value]
+    if isinstance(tag, (nbt.TAG_Int_Array, nbt.TAG_Long_Array)):
+        return list(tag.value)
+    return tag.value
+
+
+def tag_list(name, tag_type, tags):
+    tag = nbt.TAG_List(name=name, type=tag_type)
+    if tag_type is None:  # empty lists are written by Minecraft with an item type of TAG_End
+        tag.tagID = nbt.TAG_END
+    tag.tags.extend(tags)
+    return tag
+
+
+def array(tag_type, name, value):
+    tag = tag_type(name=name)
+    tag.value = value
+    return tag
+
+
+def compound(name, tags):
+    tag = nbt.TAG_Compound(name=name)
+    tag.tags.extend(tags)
+    return tag
+
+
+def item(item_id, count_tag, count):
+    return compound(None, [nbt.TAG_String(name="id", value=item_id), nbt.TAG_Byte(name=count_tag, value=count),
+                           nbt.TAG_Byte(name="Slot", value=0)])
+
+
+def playerdata(inventory=()):
+    root = nbt.NBTFile()
+    root.name = ""
+    root.tags.extend([
+        nbt.TAG_Byte(name="OnGround", value=-3),
+        nbt.TAG_Short(name="SleepTimer", value=-1234),
+        nbt.TAG_Int(name="XpTotal", value=2 ** 31 - 1),
+        nbt.TAG_Int(name="XpLevel", value=30),
+        nbt.TAG_Int(name="Score", value=-5),
+        nbt.TAG_Long(name="UUIDMost", value=-2 ** 63),
+        nbt.TAG_Float(name="Health", value=19.5),
+        nbt.TAG_Int(name="foodLevel", value=20),
+        nbt.TAG_Double(name="FallDistance", value=0.1),
+        nbt.TAG_String(name="Dimension", value="minecraft:the_nether"),
+        nbt.TAG_String(name="CustomName", value="Grüße \"quoted\""),
+        array(nbt.TAG_Byte_Array, "Bytes", bytearray([0, 1, 127, 128, 255])),
+        array(nbt.TAG_Int_Array, "UUID", [1, -2, 2 ** 31 - 1, -2 ** 31]),
+        array(nbt.TAG_Long_Array, "Longs", [2 ** 62, -1]),
+        tag_list("Pos", nbt.TAG_Double, [nbt.TAG_Double(value=v) for v in (1.5, 64.0, -3.25)]),
+        tag_list("Rotation", nbt.TAG_Float, [nbt.TAG_Float(value=v) for v in (90.0, -45.5)]),
+        tag_list("Nested", nbt.TAG_List, [tag_list(None, nbt.TAG_Int, [nbt.TAG_Int(value=1), nbt.TAG_Int(value=2)]),
+                                          tag_list(None, nbt.TAG_String, [nbt.TAG_String(value="a")])]),
+        tag_list("Empty", None, []),
+        tag_list("Inventory", nbt.TAG_Compound, list(inventory)),
+        compound("abilities", [nbt.TAG_Byte(name="flying", value=1), nbt.TAG_Float(name="walkSpeed", value=0.1),
+                               compound("deep", [nbt.TAG_Int(name="x", value=7)])]),
+    ])
+    return root
+
+
+def write_gzip(path, root):
+    root.write_file(str(path))
+    return path
+
+
+def uncompressed(root):
+    buffer = io.BytesIO()
+    root._render_buffer(buffer)
+    return bytes([nbt.TAG_COMPOUND]) + b"\x00\x00" + buffer.getvalue()
+
+
+def test_whole_file_matches_nbt_library(tmp_path):
+    path = write_gzip(tmp_path / "player.dat", playerdata([item("minecraft:stone", "Count", 3)]))
+    assert read_nbt_file(str(path), None) == to_python(nbt.NBTFile(str(path)))
+
+
+def test_all_compressions_agree(tmp_path):
+    root = playerdata()
+    path = write_gzip(tmp_path / "player.dat", root)
+    raw = uncompressed(root)
+    expected = to_python(nbt.NBTFile(str(path)))
+    assert read_nbt(raw, None) == expected
+    assert read_nbt_bytes(zlib.compress(raw), None) == expected
+    assert read_nbt_bytes(path.read_bytes(), None) == expected
+
+
+def test_empty_and_nested_lists(tmp_path):
+    values = read_nbt_file(str(write_gzip(tmp_path / "player.dat", playerdata())), None)
+    assert values["Empty"] == []
+    assert values["Nested"] == [[1, 2], ["a"]]
+    assert values["Bytes"] == [0, 1, 127, -128, -1]
+    assert values["Longs"] == [2 ** 62, -1]
+
+
+def test_dotted_paths_select_subtrees(tmp_path):
+    path = write_gzip(tmp_path / "player.dat", playerdata())
+    wanted = nbt_paths(["abilities.flying", "abilities.deep.x", "Pos", "Dimension", "missing", "abilities.missing"])
+    assert read_nbt_file(str(path), wanted) == {
+        "abilities": {"flying": 1, "deep": {"x": 7}},
+        "Pos": [1.5, 64.0, -3.25],
+        "Dimension": "minecraft:the_nether",
+    }
+
+
+def test_whole_value_wins_over_subpath(tmp_path):
+    path = write_gzip(tmp_path / "player.dat", playerdata())
+    expected = to_python(nbt.NBTFile(str(path)))["abilities"]
+    assert read_nbt_file(str(path), nbt_paths(["abilities", "abilities.flying"])) == {"abilities": expected}
+    assert read_nbt_file(str(path), nbt_paths(["abilities.flying", "abilities"])) == {"abilities": expected}
+
+
+def test_wanted_tree_applies_to_each_compound_of_a_list(tmp_path):
+    inventory = [item("minecraft:stone", "Count", 3), item("minecraft:dirt", "count", 5)]
+    path = write_gzip(tmp_path / "player.dat", playerdata(inventory))
+    assert read_nbt_file(str(path), {"Inventory": {"id": None, "Count": None, "count": None}}) == {
+        "Inventory": [{"id": "minecraft:stone", "Count": 3}, {"id": "minecraft:dirt", "count": 5}]}
+
+
+def test_scalar_path_into_compound_is_skipped(tmp_path):
+    path = write_gzip(tmp_path / "player.dat", playerdata())
+    assert read_nbt_file(str(path), nbt_paths(["XpLevel.below"])) == {}
+
+
+def test_truncated_file_raises(tmp_path):
+    raw = uncompressed(playerdata())
+    with pytest.raises(Exception):
+        read_nbt(raw[:len(raw) // 2], None)
+
+
+def write_player(tmp_path, root):
+    stats = tmp_path / "stats.json"
+    stats.write_text(json.dumps({"stats": {"minecraft:mined": {"minecraft:stone": 4}}, "DataVersion": 2586}))
+    advancements = tmp_path / "advancements.json"
+    advancements.write_text(json.dumps({"minecraft:story/root": {"done": True},
+                                        "minecraft:story/mine_stone": {"done": False}, "DataVersion": 2586}))
+    return str(stats), str(write_gzip(tmp_path / "player.dat", root)), str(advancements)
+
+
+def test_player_files(tmp_path):
+    inventory = [item("minecraft:diamond", "Count", 3), item("minecraft:diamond", "count", 2),
+                 item("minecraft:stone", "Count", 64), item("minecraft:dirt", "Count", 1)]
+    timings = dict()
+    data = read_player_files(*write_player(tmp_path, playerdata(inventory)),
+                             playerdata_tags=("abilities.flying", "Pos", "Dimension", "NotThere"),
+                             inventory_items=frozenset(["minecraft:diamond", "minecraft:stone", "minecraft:gold"]),
+                             timings=timings)
+    assert data["stat.XpTotal"] == 2 ** 31 - 1
+    assert data["stat.Health"] == 19.5
+    assert data["stat.advancements"] == 1
+    assert data["stat.nbt"] == {"abilities.flying": 1, "Pos.0": 1.5, "Pos.1": 64.0, "Pos.2": -3.25}
+    assert data["stat.nbtInfo"] == {"Dimension": "minecraft:the_nether"}
+    assert data["stat.inventory"] == {"minecraft:diamond": 5, "minecraft:stone": 64}
+    assert set(timings) == {"stats", "playerdata", "advancements"}
+
+
+def test_player_files_without_optional_tags(tmp_path):
+    root = playerdata()
+    for name in ("Score", "Health"):
+        root.tags.remove(root[name])
+    data = read_player_files(*write_player(tmp_path, root))
+    assert "stat.Score" not in data and "stat.Health" not in data
+    assert data["stat.XpLevel"] == 30
+    assert "stat.nbt" not in data and "stat.inventory" not in data
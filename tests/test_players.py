@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from benchmark import generate_world
+from minecraft_exporter import ERRORS, MinecraftCollector
+
+
+@pytest.fixture
+def world(tmp_path, monkeypatch):
+    uuids = generate_world(str(tmp_path), 5, blocks=30, inventory=5)
+    monkeypatch.setenv('WORLD_DIR', str(tmp_path / "world"))
+    monkeypatch.setenv('USERCACHE_FILE', str(tmp_path / "usercache.json"))
+    monkeypatch.setenv('NAME_CACHE_FILE', "")
+    return tmp_path, uuids
+
+
+def break_playerdata(tmp_path, uuid):
+    with open(tmp_path / "world" / "playerdata" / (uuid + ".dat"), "wb") as dat_file:
+        dat_file.write(b"garbage")
+
+
+def parse_errors():
+    return ERRORS.labels('parse')._value.get()
+
+
+def test_broken_player_is_parsed_once_per_change(world):
+    tmp_path, uuids = world
+    break_playerdata(tmp_path, uuids[0])
+    collector = MinecraftCollector()
+    errors = parse_errors()
+    player_samples, _ = collector.collect_samples()
+    assert player_samples[uuids[0]] == {}
+    assert parse_errors() == errors + 1
+    collector.collect_samples()
+    assert parse_errors() == errors + 1
+    (tmp_path / "world" / "playerdata" / (uuids[0] + ".dat")).write_bytes(b"other garbage")
+    collector.collect_samples()
+    assert parse_errors() == errors + 2
+
+
+def test_profile_creates_its_directory(world, monkeypatch):
+    tmp_path, _ = world
+    monkeypatch.setenv('PROFILE_DIR', str(tmp_path / "profiles"))
+    collector = MinecraftCollector()
+    collector.request_profile()
+    assert collector.collect_metrics()
+    assert any(name.endswith(".txt") for name in os.listdir(tmp_path / "profiles"))
+
+
+def test_unwritable_profile_keeps_the_collection(world, monkeypatch):
+    tmp_path, _ = world
+    (tmp_path / "profiles").write_text("not a directory")
+    monkeypatch.setenv('PROFILE_DIR', str(tmp_path / "profiles"))
+    collector = MinecraftCollector()
+    collector.request_profile()
+    errors = ERRORS.labels('profile')._value.get()
+    assert collector.collect_metrics()
+    assert ERRORS.labels('profile')._value.get() == errors + 1
+
+
+def test_dormant_samples_are_not_served_after_a_failed_refresh(world, monkeypatch):
+    tmp_path, uuids = world
+    monkeypatch.setenv('DORMANT_REFRESH_INTERVAL', "3600")
+    monkeypatch.setenv('ACTIVE_PLAYER_WINDOW', "0")
+    monkeypatch.setenv('SERVER_AGGREGATES', "blocks_mined")
+    collector = MinecraftCollector()
+    player_samples, _ = collector.collect_samples()
+    assert player_samples[uuids[0]]
+    total = sum(collector.server_totals['blocks_mined'].values())
+
+    break_playerdata(tmp_path, uuids[0])
+    collector.player_refresh_due[uuids[0]] = 0
+    for _ in range(3):
+        player_samples, _ = collector.collect_samples()
+        assert player_samples[uuids[0]] == {}
+    assert sum(collector.server_totals['blocks_mined'].values()) < total
@@ -0,0 +1,81 @@
+import socket
+import sys
+import time
+
+import pytest
+
+from benchmark import FakeRconServer, RCON_RESPONSES
+from minecraft_exporter import RconSession
+
+
+@pytest.fixture
+def server():
+    server = FakeRconServer({"forge entity list": 0.5})
+    yield server
+    server.stop()
+
+
+def session(port, timeout=2.0, cache_ttl=0.0):
+    return RconSession("127.0.0.1", port, "password", 2, timeout, 5.0, cache_ttl)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_runs_commands(server):
+    rcon = session(server.port)
+    assert rcon.run("list", "forge tps") == [RCON_RESPONSES["list"], RCON_RESPONSES["forge tps"]]
+    # the connections are kept for the next run
+    assert rcon.idle.qsize() > 0
+    assert rcon.run("list") == [RCON_RESPONSES["list"]]
+
+
+def test_slow_command_is_served_to_the_next_run(server):
+    rcon = session(server.port, timeout=0.2)
+    started = time.monotonic()
+    assert rcon.run("list", "forge entity list") == [RCON_RESPONSES["list"], None]
+    assert time.monotonic() - started < 0.45
+    time.sleep(0.5)
+    # the late response is served once while the command runs again
+    assert rcon.run("forge entity list") == [RCON_RESPONSES["forge entity list"]]
+    assert rcon.run("forge entity list") == [None]
+
+
+def test_cache_ttl(server):
+    rcon = session(server.port, cache_ttl=60)
+    assert rcon.run("forge entity list") == [RCON_RESPONSES["forge entity list"]]
+    started = time.monotonic()
+    assert rcon.run("forge entity list") == [RCON_RESPONSES["forge entity list"]]
+    assert time.monotonic() - started < 0.1
+
+
+def test_reconnects_after_server_restart(server):
+    rcon = session(server.port)
+    assert rcon.run("list") == [RCON_RESPONSES["list"]]
+    port = server.port
+    server.stop()
+    restarted = FakeRconServer(port=port)
+    try:
+        # the idle connection died with the old server, the command is retried on a new one
+        assert rcon.run("list") == [RCON_RESPONSES["list"]]
+        assert rcon.failures == 0
+    finally:
+        restarted.stop()
+
+
+def test_refused_connection():
+    rcon = session(free_port())
+    switch_interval = sys.getswitchinterval()
+    # commands failing before their done callback is attached, eg in backoff without even connecting
+    sys.setswitchinterval(1e-6)
+    try:
+        for i in range(1000):
+            assert rcon.run("list", "forge tps") == [None, None]
+            if i % 2:
+                rcon.retry_at = 0
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert rcon.failures > 0
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+from nbt import nbt, region
+
+from minecraft_exporter import ERRORS, WorldScanner
+
+
+def entity_list(name, ids):
+    tag = nbt.TAG_List(name=name, type=nbt.TAG_Compound)
+    for entity_id in ids:
+        entity = nbt.TAG_Compound()
+        entity.tags.append(nbt.TAG_String(name='id', value=entity_id))
+        tag.tags.append(entity)
+    return tag
+
+
+def write_region(path, chunks):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    region_file = region.RegionFile(path)
+    for (x, z), (entities, tile_entities) in chunks.items():
+        chunk = nbt.NBTFile()
+        level = nbt.TAG_Compound(name='Level')
+        level.tags.append(entity_list('Entities', entities))
+        level.tags.append(entity_list('TileEntities', tile_entities))
+        chunk.tags.append(level)
+        region_file.write_chunk(x, z, chunk)
+    region_file.close()
+
+
+@pytest.fixture
+def world(tmp_path):
+    world = tmp_path / "world"
+    write_region(str(world / "region" / "r.0.0.mca"), {(0, 0): (['minecraft:zombie'] * 3, ['minecraft:chest']),
+                                                        (1, 0): (['minecraft:cow'], [])})
+    write_region(str(world / "DIM-1" / "region" / "r.-1.0.mca"), {(31, 2): ([], ['minecraft:hopper'] * 7)})
+    return str(world)
+
+
+def scanner(world, index_directory):
+    return WorldScanner(world, str(index_directory), 60, 10, 0)
+
+
+def test_counts(world, tmp_path):
+    world_scanner = scanner(world, tmp_path / "index")
+    world_scanner.scan()
+    chunks, entities, tile_entities, top_entities, top_tile_entities = world_scanner.results
+    assert chunks == {'minecraft:overworld': 2, 'minecraft:the_nether': 1}
+    assert entities == {('minecraft:overworld', 'minecraft:zombie'): 3, ('minecraft:overworld', 'minecraft:cow'): 1}
+    assert tile_entities == {('minecraft:overworld', 'minecraft:chest'): 1, ('minecraft:the_nether', 'minecraft:hopper'): 7}
+    assert top_entities[0] == (3, 'minecraft:overworld', (0, 0))
+    assert top_tile_entities[0] == (7, 'minecraft:the_nether', (-1, 2))
+
+
+def test_only_changed_regions_are_saved(world, tmp_path):
+    index = tmp_path / "index"
+    world_scanner = scanner(world, index)
+    world_scanner.scan()
+    files = {name: os.stat(index / name).st_mtime_ns for name in os.listdir(index)}
+    assert len(files) == 2
+
+    nether = os.path.join(world, "DIM-1", "region", "r.-1.0.mca")
+    write_region(nether, {(31, 2): ([], ['minecraft:hopper'] * 2)})
+    os.utime(nether, ns=(1, 1))
+    world_scanner.scan()
+    rewritten = {name for name in files if os.stat(index / name).st_mtime_ns != files[name]}
+    assert rewritten == {os.path.basename(world_scanner.index_path(nether))}
+
+    os.remove(nether)
+    world_scanner.scan()
+    assert len(os.listdir(index)) == 1
+
+
+def test_index_survives_restarts(world, tmp_path):
+    index = tmp_path / "index"
+    first = scanner(world, index)
+    first.scan()
+    second = scanner(world, index)
+    assert second.regions == first.regions
+    second.scan()
+    assert second.results == first.results
+
+
+def test_truncated_region_fails_the_chunk_read(world, tmp_path):
+    overworld = os.path.join(world, "region", "r.0.0.mca")
+    os.truncate(overworld, 8192 + 16)
+    errors = ERRORS.labels('world_scan')._value.get()
+    world_scanner = scanner(world, tmp_path / "index")
+    world_scanner.scan()
+    chunks, entities, _, _, _ = world_scanner.results
+    assert chunks['minecraft:overworld'] == 2
+    assert entities == {}
+    assert ERRORS.labels('world_scan')._value.get() == errors + 2